@@ -59,10 +59,15 @@ class EnvoEnvComm(envo.Env):
     #         ),
     #     ]
     #
-    @command
+    # rewrites sources, so commands reading them depend on it instead of running alongside
+    @command(inputs=["envo/**/*.py", "tests/**/*.py", "env_*.py"])
+    def black(self) -> None:
+        logger.info("Running black")
+        run("black .", print_output=False)
+
+    @command(inputs=["envo/**/*.py", "tests/**/*.py", "env_*.py", ".flake8"], deps=["black"])
     def flake(self) -> None:
         logger.info("Running flake8")
-        run("black .", print_output=False)
         run("flake8")
     #
     # @command(prop=False, glob=True)
@@ -91,15 +96,10 @@ class EnvoEnvComm(envo.Env):
     # logger.info("Running autoflake")
     # run("autoflake --remove-all-unused-imports -i .")
 
-    @command(glob=True)
+    @command(glob=True, inputs=["envo/**/*.py", "mypy.ini"], deps=["black"])
     def mypy(self) -> None:
         logger.info("Running mypy")
         run("mypy envo")
-    #
-    # @command(glob=True)
-    # def black(self) -> None:
-    #     logger.info("Running black")
-    #     run("black .")
 
     # @command(glob=True)
     # def bootstrap(self):
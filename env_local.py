@@ -16,16 +16,14 @@ class EnvoEnv(EnvoEnvComm):  # type: ignore
 
         # Define your variables here
 
-    @command(glob=True)
+    @command(glob=True, deps=["black"])
     def test(self) -> None:
         logger.info("Running tests")
         run("pytest tests -v")
 
-    @command(glob=True)
+    @command(glob=True, deps=["flake", "mypy", "test"])
     def ci(self) -> None:
-        self.flake()
-        self.mypy()
-        self.test()
+        pass
 
 
 Env = EnvoEnv
@@ -1,4 +1,6 @@
-from .devops import run  # noqa F401
+from .devops import run, run_iter, run_parallel  # noqa F401
 from .env import *  # noqa F401
 from .scripts import *  # noqa F401
 from .misc import EnvoError  # noqa F401
+from .profiling import profile  # noqa F401
+from .jobs import bg  # noqa F401
@@ -0,0 +1,110 @@
+import hashlib
+from pathlib import Path
+from typing import Dict, List
+
+from envo.misc import write_if_changed
+
+__all__ = ["compile_activation"]
+
+
+def _sh_quote(value: str) -> str:
+    return "'" + value.replace("'", "'\\''") + "'"
+
+
+def _fish_quote(value: str) -> str:
+    return "'" + value.replace("\\", "\\\\").replace("'", "\\'") + "'"
+
+
+def _dot_env_quote(value: str) -> str:
+    return '"' + value.replace("\\", "\\\\").replace('"', '\\"') + '"'
+
+
+def _render_sh(env_vars: Dict[str, str]) -> str:
+    return "".join(f"export {k}={_sh_quote(v)}\n" for k, v in env_vars.items())
+
+
+def _render_fish(env_vars: Dict[str, str]) -> str:
+    return "".join(f"set -gx {k} {_fish_quote(v)}\n" for k, v in env_vars.items())
+
+
+def _render_dot_env(env_vars: Dict[str, str]) -> str:
+    return "".join(f"{k}={_dot_env_quote(v)}\n" for k, v in env_vars.items())
+
+
+def _render_sh_loader(stage: str, script: Path, sources: List[Path]) -> str:
+    sources_str = " ".join(_sh_quote(str(s)) for s in sources)
+    return (
+        f"# Source this file to activate {stage} env.\n"
+        f"# Envo is called only when env files are newer than the compiled script.\n"
+        f"__envo_script={_sh_quote(str(script))}\n"
+        f"for __envo_src in {sources_str}; do\n"
+        f'    if [ "$__envo_src" -nt "$__envo_script" ]; then\n'
+        f"        (cd {_sh_quote(str(script.parent.parent))} && envo {stage} --compile) > /dev/null\n"
+        f"        break\n"
+        f"    fi\n"
+        f"done\n"
+        f'. "$__envo_script"\n'
+        f"unset __envo_script __envo_src\n"
+    )
+
+
+def _render_fish_loader(stage: str, script: Path, sources: List[Path]) -> str:
+    sources_str = " ".join(_fish_quote(str(s)) for s in sources)
+    root = _fish_quote(str(script.parent.parent))
+    return (
+        f"# Source this file to activate {stage} env.\n"
+        f"# Envo is called only when env files are newer than the compiled script.\n"
+        f"for __envo_src in {sources_str}\n"
+        f'    if test "$__envo_src" -nt {_fish_quote(str(script))}\n'
+        # root is passed as an argument so it's not quoted twice
+        f"        fish -c 'cd $argv[1]; and envo {stage} --compile' {root} > /dev/null\n"
+        f"        break\n"
+        f"    end\n"
+        f"end\n"
+        f"source {_fish_quote(str(script))}\n"
+        f"set -e __envo_src\n"
+    )
+
+
+def compile_activation(
+    env_vars: Dict[str, str], stage: str, root: Path, sources: List[Path]
+) -> List[Path]:
+    """
+    Write activation scripts for bash, zsh and fish and .env file to {root}/.envo.
+
+    Files are written atomically and only if their content changed.
+    Loader snippets (activate_{stage}.sh and activate_{stage}.fish) source the compiled
+    scripts directly and recompile them only when any of the sources is newer.
+
+    :param env_vars: variables to export
+    :param stage: env stage
+    :param root: env root directory
+    :param sources: env files the variables are computed from
+    :return: paths of written (or already up to date) files
+    """
+    out_dir = root / ".envo"
+    sources = [s.absolute() for s in sources]
+
+    digest = hashlib.sha256()
+    for k, v in env_vars.items():
+        digest.update(f"{k}={v}\n".encode("utf-8"))
+    header = f"# Generated by envo, do not edit. Fingerprint: {digest.hexdigest()}\n"
+
+    sh_script = out_dir / f"{stage}.bash"
+    fish_script = out_dir / f"{stage}.fish"
+    contents = {
+        sh_script: header + _render_sh(env_vars),
+        out_dir / f"{stage}.zsh": header + _render_sh(env_vars),
+        fish_script: header + _render_fish(env_vars),
+        out_dir / f"{stage}.env": header + _render_dot_env(env_vars),
+        out_dir / f"activate_{stage}.sh": _render_sh_loader(stage, sh_script, sources),
+        out_dir
+        / f"activate_{stage}.fish": _render_fish_loader(stage, fish_script, sources),
+    }
+
+    for path, content in contents.items():
+        if not write_if_changed(path, content):
+            # mark as fresh for the loaders
+            path.touch()
+
+    return list(contents.keys())
@@ -0,0 +1,426 @@
+import fcntl
+import io
+import json
+import os
+import select
+import signal
+import socket
+import struct
+import sys
+import termios
+import threading
+import tty
+from array import array
+from contextlib import redirect_stderr
+from pathlib import Path
+from threading import Thread
+from types import FrameType
+from typing import Any, Dict, List, Optional, Tuple
+
+from loguru import logger
+
+from envo.misc import EnvoError, forked_worker
+from envo.scripts import Envo, _parse_args
+
+__all__ = ["Daemon", "DaemonEnvo", "find_project_root", "find_socket", "request"]
+
+
+_header = struct.Struct("!I")
+_int = struct.Struct("!i")
+_forwarded_signals = [signal.SIGINT, signal.SIGTERM, signal.SIGHUP]
+
+
+def find_project_root() -> Path:
+    """
+    Return the closest directory containing env_comm.py.
+    """
+    path = Path(".").absolute()
+    for p in [path, *path.parents]:
+        if (p / "env_comm.py").exists():
+            return p
+
+    raise EnvoError("Couldn't find any env!\n" 'Forgot to run envo --init" first?')
+
+
+def find_socket() -> Optional[Path]:
+    """
+    Return socket path of a daemon serving current project if there's one.
+    """
+    try:
+        socket_path = find_project_root() / ".envo" / "daemon.sock"
+    except EnvoError:
+        return None
+
+    return socket_path if socket_path.exists() else None
+
+
+def _recv_exactly(sock: socket.socket, size: int) -> bytes:
+    data = b""
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise ConnectionError("Connection closed")
+        data += chunk
+    return data
+
+
+def _get_winsize(fd: int) -> bytes:
+    return fcntl.ioctl(fd, termios.TIOCGWINSZ, b"\0" * 8)
+
+
+def _get_peer_uid(sock: socket.socket) -> Optional[int]:
+    """
+    :return: uid of the process connected to unix socket, None if the platform doesn't tell
+    """
+    if not hasattr(socket, "SO_PEERCRED"):
+        return None
+
+    creds = struct.Struct("3i")
+    _, uid, _ = creds.unpack(
+        sock.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, creds.size)
+    )
+    return int(uid)
+
+
+def _proxy_terminal(master: int, fds: Tuple[int, int, int]) -> None:
+    """
+    Copy input to pty master and its output to stdout until the pty is closed.
+    """
+    old_attrs = None
+    if os.isatty(fds[0]):
+        old_attrs = termios.tcgetattr(fds[0])
+        tty.setraw(fds[0])
+
+    inputs = [fds[0], master]
+    try:
+        while True:
+            ready, _, _ = select.select(inputs, [], [])
+            if master in ready:
+                try:
+                    data = os.read(master, 65536)
+                except OSError:
+                    # EIO when all slave ends are closed
+                    break
+                if not data:
+                    break
+                os.write(fds[1], data)
+            if fds[0] in ready:
+                data = os.read(fds[0], 65536)
+                if data:
+                    os.write(master, data)
+                else:
+                    inputs.remove(fds[0])
+    finally:
+        if old_attrs:
+            termios.tcsetattr(fds[0], termios.TCSAFLUSH, old_attrs)
+
+
+def _recv_pid(sock: socket.socket) -> Tuple[int, Optional[int]]:
+    """
+    Receive pid of the process handling request and pty master fd if one was created.
+    """
+    fds = array("i")
+    data, ancdata, _, _ = sock.recvmsg(_int.size, socket.CMSG_SPACE(fds.itemsize))
+    for level, type, cmsg_data in ancdata:
+        if level == socket.SOL_SOCKET and type == socket.SCM_RIGHTS:
+            fds.frombytes(cmsg_data)
+
+    if len(data) < _int.size:
+        data += _recv_exactly(sock, _int.size - len(data))
+
+    return _int.unpack(data)[0], (fds[0] if fds else None)
+
+
+def request(
+    socket_path: Path,
+    argv: List[str],
+    fds: Tuple[int, int, int] = (0, 1, 2),
+    pty: bool = False,
+) -> Optional[int]:
+    """
+    Send envo command to the daemon and wait for it to finish.
+
+    Daemon writes output directly to passed file descriptors (stdin, stdout, stderr).
+    Signals are forwarded to the process handling the request.
+
+    :param pty: run request (interactive shell) in a new pseudo terminal proxied to passed fds
+    :return: exit code or None if daemon is not running
+    """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        try:
+            sock.connect(str(socket_path))
+        except (ConnectionRefusedError, FileNotFoundError):
+            return None
+
+        winsize = _get_winsize(fds[1]).hex() if pty and os.isatty(fds[1]) else None
+        payload = json.dumps(
+            {
+                "argv": argv,
+                "cwd": os.getcwd(),
+                "environ": dict(os.environ),
+                "pty": pty,
+                "winsize": winsize,
+            }
+        ).encode("utf-8")
+        sock.sendmsg(
+            [_header.pack(len(payload))],
+            [(socket.SOL_SOCKET, socket.SCM_RIGHTS, array("i", fds))],
+        )
+        sock.sendall(payload)
+
+        pid, master = _recv_pid(sock)
+
+        def forward(signum: int, frame: Optional[FrameType]) -> None:
+            os.kill(pid, signum)
+
+        def resize(signum: int, frame: Optional[FrameType]) -> None:
+            if master is not None:
+                fcntl.ioctl(master, termios.TIOCSWINSZ, _get_winsize(fds[1]))
+
+        handlers: Dict[int, Any] = {}
+        if threading.current_thread() is threading.main_thread():
+            handlers = {s: signal.signal(s, forward) for s in _forwarded_signals}
+            if master is not None and os.isatty(fds[1]):
+                handlers[signal.SIGWINCH] = signal.signal(signal.SIGWINCH, resize)
+
+        try:
+            if master is not None:
+                _proxy_terminal(master, fds)
+                os.close(master)
+            code: int = _int.unpack(_recv_exactly(sock, _int.size))[0]
+        finally:
+            for s, h in handlers.items():
+                signal.signal(s, h)
+
+    return code
+
+
+class DaemonEnvo(Envo):
+    """
+    Envo keeping imported env module between requests.
+
+    Module is imported again when env files change.
+    """
+
+    def __init__(self, sets: Envo.Sets) -> None:
+        super().__init__(sets)
+        self._module: Any = None
+        self._mtimes: Dict[Path, int] = {}
+
+    def _get_mtimes(self) -> Dict[Path, int]:
+        files = []
+        for d in self.env_dirs:
+            files.extend([d / "env_comm.py", d / f"env_{self.se.stage}.py"])
+        return {f: f.stat().st_mtime_ns for f in files if f.exists()}
+
+    def preload(self) -> None:
+        mtimes = self._get_mtimes()
+        if self._module is not None and mtimes == self._mtimes:
+            return
+
+        if self._mtimes:
+            logger.info(f'Reloading "{self.se.stage}" env...')
+
+        self._module = None
+        self._mtimes = mtimes
+        try:
+            self.create_env()
+        except Exception as e:
+            # error will be reported to the client when handling request
+            self._module = None
+            logger.error(f'Couldn\'t load "{self.se.stage}" env ({e})')
+
+    def _import_env_module(self, env_file: Path) -> Any:
+        if self._module is None:
+            self._module = super()._import_env_module(env_file)
+        return self._module
+
+
+class Daemon:
+    """
+    Per project server handling envo requests over a unix socket.
+
+    Envs of all stages and xonsh are kept imported, each request is handled in a forked process
+    that writes directly to the client's stdin, stdout and stderr.
+    Interactive shells are forked into a new pty session proxied by the client.
+    """
+
+    def __init__(self, root: Path) -> None:
+        self.root = root
+        self.socket_path = root / ".envo" / "daemon.sock"
+        self.envos: Dict[str, DaemonEnvo] = {}
+        self._sock: Optional[socket.socket] = None
+
+    def serve(self) -> None:
+        os.chdir(str(self.root))
+        sys.path.insert(0, str(self.root))
+
+        # import xonsh and prompt toolkit upfront so forked shells don't have to
+        from envo import shell  # noqa: F401
+        import xonsh.history.main  # noqa: F401
+        import xonsh.main  # noqa: F401
+
+        for env_file in sorted(self.root.glob("env_*.py")):
+            stage = env_file.stem.replace("env_", "", 1)
+            if stage != "comm":
+                self._get_envo(stage)
+
+        self.socket_path.parent.mkdir(parents=True, exist_ok=True)
+        if self.socket_path.exists():
+            self.socket_path.unlink()
+
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        # requests run commands as the daemon owner, only the owner may connect
+        umask = os.umask(0o177)
+        try:
+            self._sock.bind(str(self.socket_path))
+        finally:
+            os.umask(umask)
+        self._sock.listen()
+        if threading.current_thread() is threading.main_thread():
+            signal.signal(signal.SIGTERM, lambda *args: sys.exit(0))
+        logger.info(f"Envo daemon listening on {str(self.socket_path)} 👂")
+
+        try:
+            while True:
+                try:
+                    conn, _ = self._sock.accept()
+                except OSError:
+                    # socket closed by stop()
+                    break
+                try:
+                    self._handle_connection(conn)
+                except Exception as e:
+                    logger.error(f"Failed to handle request ({e})")
+                    conn.close()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self._sock.close()
+            if self.socket_path.exists():
+                self.socket_path.unlink()
+
+    def stop(self) -> None:
+        if self._sock:
+            self._sock.shutdown(socket.SHUT_RDWR)
+
+    def _get_envo(self, stage: str) -> DaemonEnvo:
+        if stage not in self.envos:
+            self.envos[stage] = DaemonEnvo(
+                Envo.Sets(stage=stage, addons=[], init=False)
+            )
+        envo = self.envos[stage]
+        if envo.env_dirs:
+            envo.preload()
+        return envo
+
+    def _receive(self, conn: socket.socket) -> Tuple[List[int], Dict[str, Any]]:
+        fds = array("i")
+        data, ancdata, _, _ = conn.recvmsg(
+            _header.size, socket.CMSG_SPACE(3 * fds.itemsize)
+        )
+        for level, type, cmsg_data in ancdata:
+            if level == socket.SOL_SOCKET and type == socket.SCM_RIGHTS:
+                fds.frombytes(cmsg_data)
+
+        if len(data) != _header.size or len(fds) != 3:
+            for fd in fds:
+                os.close(fd)
+            raise ConnectionError("Invalid request")
+
+        (size,) = _header.unpack(data)
+        return list(fds), json.loads(_recv_exactly(conn, size).decode("utf-8"))
+
+    def _handle_connection(self, conn: socket.socket) -> None:
+        uid = _get_peer_uid(conn)
+        if uid is not None and uid != os.getuid():
+            logger.error(f"Rejected request of user {uid}")
+            conn.close()
+            return
+
+        try:
+            fds, req = self._receive(conn)
+        except (OSError, ValueError) as e:
+            logger.error(f"Bad request ({e})")
+            conn.close()
+            return
+
+        try:
+            # invalid arguments are reported by the child
+            with redirect_stderr(io.StringIO()):
+                args = _parse_args(req["argv"])
+            envo: Optional[DaemonEnvo] = self._get_envo(args.stage)
+        except SystemExit:
+            args = None
+            envo = None
+
+        master: Optional[int] = None
+        if req.get("pty"):
+            # shell runs in its own session with a new pty as controlling terminal,
+            # client copies data between its terminal and the pty master
+            master, slave = os.openpty()
+            if req.get("winsize"):
+                fcntl.ioctl(slave, termios.TIOCSWINSZ, bytes.fromhex(req["winsize"]))
+            for fd in fds:
+                os.close(fd)
+            fds = [slave] * 3
+
+        sys.stdout.flush()
+        sys.stderr.flush()
+        pid = os.fork()
+        if pid == 0:
+            if master is not None:
+                os.close(master)
+                os.setsid()
+                fcntl.ioctl(fds[0], termios.TIOCSCTTY, 0)
+            self._child(envo, args, fds, req)
+
+        for fd in set(fds):
+            os.close(fd)
+
+        if master is not None:
+            conn.sendmsg(
+                [_int.pack(pid)],
+                [(socket.SOL_SOCKET, socket.SCM_RIGHTS, array("i", [master]))],
+            )
+            os.close(master)
+        else:
+            conn.sendall(_int.pack(pid))
+        Thread(target=self._wait_child, args=(conn, pid)).start()
+
+    def _wait_child(self, conn: socket.socket, pid: int) -> None:
+        _, status = os.waitpid(pid, 0)
+        if os.WIFSIGNALED(status):
+            code = 128 + os.WTERMSIG(status)
+        else:
+            code = os.WEXITSTATUS(status)
+
+        try:
+            conn.sendall(_int.pack(code))
+        except OSError:
+            pass
+        finally:
+            conn.close()
+
+    def _child(
+        self,
+        envo: Optional[DaemonEnvo],
+        args: Any,
+        fds: List[int],
+        req: Dict[str, Any],
+    ) -> None:
+        with forked_worker(fds, req["environ"], _forwarded_signals):
+            assert self._sock
+            self._sock.close()
+            os.chdir(req["cwd"])
+            if args is None or envo is None:
+                # reports invalid arguments
+                _parse_args(req["argv"])
+                sys.exit(1)
+
+            envo.environ_before = os.environ.copy()  # type: ignore
+
+            try:
+                envo.handle_command(args)
+            except EnvoError as e:
+                logger.error(e)
@@ -1,18 +1,67 @@
 import os
 import re
+import selectors
+import signal
+import subprocess
 import sys
+import tempfile
+import time
+import uuid
+from dataclasses import dataclass, field
 from getpass import getpass
-from typing import List
+from typing import IO, Any, Callable, Dict, Iterator, List, Optional, Tuple
 
 import pexpect
 from loguru import logger
 from tqdm import tqdm
 
+from envo.misc import LineBuffer
+from envo.parallel import run_dag
+from envo.trace import tracer
+
 
 class CommandError(RuntimeError):
     pass
 
 
+@dataclass
+class RunEvent:
+    """
+    Event emitted while streaming output of commands.
+
+    type is one of "start", "output", "exit" or "finish" (emitted once after all commands).
+    """
+
+    type: str
+    index: int
+    command: str
+    line: str = ""
+    stream: str = "stdout"
+    ret_code: int = 0
+    user_time: float = 0.0
+    sys_time: float = 0.0
+    max_rss: Optional[int] = None
+
+
+@dataclass
+class RunResult:
+    """
+    Result of a single command executed by run.
+
+    Times are in seconds.
+    When running in a pty stderr is merged into stdout.
+    """
+
+    command: str
+    output: List[str] = field(default_factory=list)
+    exit_code: int = 0
+    wall_time: float = 0.0
+    user_time: float = 0.0
+    sys_time: float = 0.0
+    stdout_bytes: int = 0
+    stderr_bytes: int = 0
+
+
 class CustomPrint:
     def __init__(self, prompt: str, command: str) -> None:
         self.old_stdout = sys.stdout
@@ -33,22 +82,375 @@ class CustomPrint:
         self.old_stdout.flush()
 
 
-def run(
-    command: str,
-    ignore_errors: bool = False,
-    print_output: bool = True,
-    progress_bar: bool = False,
-) -> List[str]:
-    # preprocess
+class MarkerFilterPrint:
+    """
+    Print output of a batched script hiding the markers that frame each command.
+    """
+
+    def __init__(self, marker: str) -> None:
+        self.old_stdout = sys.stdout
+        self.marker = marker
+        # incomplete line is kept until the rest arrives, it might be a marker
+        self.lines = LineBuffer()
+
+    def write(self, text: bytes) -> None:
+        for line in self.lines.feed(text):
+            self._write_line(line)
+
+    def _write_line(self, line: str) -> None:
+        if self.marker in line:
+            # command output not ending with a new line is followed by the end marker
+            line = line[: line.index(self.marker)]
+        self.old_stdout.write(line)
+
+    def flush(self) -> None:
+        self.old_stdout.flush()
+
+
+def _frame_script(
+    commands: List[str], token: str, stop_on_error: bool, mark_stderr: bool = False
+) -> str:
+    """
+    Wrap each command with start and end markers.
+
+    End marker carries the exit code and cpu time (in clock ticks) used by the shell so far
+    so outputs, exit codes and timings of the whole script can be read in a single pass.
+    """
+    # utime + cutime, stime + cstime fields of /proc/<pid>/stat, read without forking
+    user_ticks = "$((__pg_stat[13] + __pg_stat[15]))"
+    sys_ticks = "$((__pg_stat[14] + __pg_stat[16]))"
+
+    lines: List[str] = []
+    for i, c in enumerate(commands):
+        lines.append(f'echo "##PG_{token}_START_{i}##"')
+        if mark_stderr:
+            lines.append(f'echo "##PG_{token}_START_{i}##" >&2')
+        lines.append(c)
+        lines.append(
+            "__pg_ret=$?; read -r -a __pg_stat < /proc/$$/stat; "
+            f'echo "##PG_{token}_END_{i}_${{__pg_ret}}_{user_ticks}_{sys_ticks}##"'
+        )
+        if stop_on_error:
+            lines.append('[ "$__pg_ret" -eq 0 ] || return "$__pg_ret"')
+
+    return "\n".join(lines) + "\n"
+
+
+class _CpuClock:
+    """
+    Turn cumulative cpu ticks reported by the shell into per command times.
+    """
+
+    def __init__(self) -> None:
+        self.ticks_per_s = os.sysconf("SC_CLK_TCK")
+        self.user_ticks = 0
+        self.sys_ticks = 0
+
+    def tick(self, user_ticks: int, sys_ticks: int) -> Tuple[float, float]:
+        user_time = (user_ticks - self.user_ticks) / self.ticks_per_s
+        sys_time = (sys_ticks - self.sys_ticks) / self.ticks_per_s
+        self.user_ticks = user_ticks
+        self.sys_ticks = sys_ticks
+        return user_time, sys_time
+
+
+def _run_batch(
+    p: pexpect.spawn,
+    commands: List[str],
+    prompt: str,
+    ignore_errors: bool,
+    print_output: bool,
+    pbar: Optional[tqdm],
+) -> List[RunResult]:
+    """
+    Send all commands at once and parse framed outputs.
+    """
+    results: List[RunResult] = []
+    token = uuid.uuid4().hex
+    marker = f"##PG_{token}"
+    clock = _CpuClock()
+
+    script = _write_script(commands, token, stop_on_error=not ignore_errors)
+
+    try:
+        if print_output:
+            p.logfile_read = MarkerFilterPrint(marker=marker)
+        p.sendline(f"source {script}")
+
+        for i, c in enumerate(commands):
+            if "PG_DEBUG" in os.environ:
+                logger.debug(c)
+
+            p.expect(rf"{marker}_START_{i}##\r?\n", timeout=60 * 15)
+            start = time.monotonic()
+            p.expect(rf"{marker}_END_{i}_(\d+)_(\d+)_(\d+)##", timeout=60 * 15)
+
+            raw_outputs: List[bytes] = p.before.splitlines()
+            user_time, sys_time = clock.tick(
+                int(p.match.group(2)), int(p.match.group(3))
+            )
+            end = time.monotonic()
+            tracer.complete(c, start, end, cat="run", exit_code=p.match.group(1))
+            result = RunResult(
+                command=c,
+                output=[s.decode("utf-8").strip() for s in raw_outputs],
+                exit_code=int(p.match.group(1)),
+                wall_time=end - start,
+                user_time=user_time,
+                sys_time=sys_time,
+                stdout_bytes=len(p.before),
+            )
+            results.append(result)
+
+            if not ignore_errors and result.exit_code:
+                break
+
+            if pbar:
+                pbar.update(1)
+        else:
+            p.expect(prompt)
+    finally:
+        if print_output:
+            p.logfile_read.flush()
+            p.logfile_read = None
+        os.unlink(script)
+
+    return results
+
+
+def _write_script(
+    commands: List[str], token: str, stop_on_error: bool, mark_stderr: bool = False
+) -> str:
+    """
+    Write framed commands to a temporary script.
+
+    :return: path to the script
+    """
+    script = tempfile.NamedTemporaryFile("w", prefix="pg_", suffix=".sh", delete=False)
+    script.write(_frame_script(commands, token, stop_on_error, mark_stderr))
+    script.close()
+    return script.name
+
+
+def _read_lines(files: Dict[str, IO[bytes]]) -> Iterator[Tuple[str, str]]:
+    """
+    Read lines from multiple pipes as they arrive.
+
+    :param files: stream name to pipe mapping
+    :return: (stream name, line) pairs
+    """
+    selector = selectors.DefaultSelector()
+    buffers: Dict[str, LineBuffer] = {}
+    for name, f in files.items():
+        selector.register(f, selectors.EVENT_READ, name)
+        buffers[name] = LineBuffer()
+
+    while selector.get_map():
+        for key, _ in selector.select():
+            name = key.data
+            chunk = os.read(key.fd, 64 * 1024)
+            if not chunk:
+                selector.unregister(key.fileobj)
+                rest = buffers[name].take_pending()
+                if rest:
+                    yield name, rest
+                continue
+
+            for line in buffers[name].feed(chunk):
+                yield name, line
+
+    selector.close()
+
+
+def _stream_script(
+    commands: List[str], stop_on_error: bool, split_stderr: bool = False
+) -> Iterator[RunEvent]:
+    """
+    Run commands in bash over plain pipes and read their output as it arrives.
+
+    :param split_stderr: read stderr from a separate pipe instead of merging it into stdout
+    """
+    token = uuid.uuid4().hex
+    marker = f"##PG_{token}"
+    marker_re = re.compile(rf"{marker}_(START|END)_(\d+)(?:_(\d+)_(\d+)_(\d+))?##")
+    clock = _CpuClock()
+
+    script = _write_script(commands, token, stop_on_error, mark_stderr=split_stderr)
+
+    proc = subprocess.Popen(
+        ["bash", "--norc", "--noprofile", "-c", 'source "$0"', script],
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE if split_stderr else subprocess.STDOUT,
+        env=os.environ,
+        # own process group so commands still running can be killed together with bash
+        start_new_session=True,
+    )
+    assert proc.stdout
+
+    files = {"stdout": proc.stdout}
+    if proc.stderr:
+        files["stderr"] = proc.stderr
+
+    finished = False
+    running: Optional[int] = None
+    try:
+        # output before the first command (like bash warnings) is skipped
+        current = {name: -1 for name in files.keys()}
+        for stream, line in _read_lines(files):
+            i = current[stream]
+            if marker not in line:
+                if i >= 0:
+                    yield RunEvent("output", i, commands[i], line=line, stream=stream)
+                continue
+
+            # command output not ending with a new line is followed by the end marker
+            before = line[: line.index(marker)]
+            if before and i >= 0:
+                yield RunEvent("output", i, commands[i], line=before, stream=stream)
+
+            match = marker_re.search(line)
+            assert match
+            i = current[stream] = int(match.group(2))
+            if stream == "stderr":
+                continue
+
+            if match.group(1) == "START":
+                running = i
+                yield RunEvent("start", i, commands[i])
+            else:
+                running = None
+                user_time, sys_time = clock.tick(
+                    int(match.group(4)), int(match.group(5))
+                )
+                yield RunEvent(
+                    "exit",
+                    i,
+                    commands[i],
+                    ret_code=int(match.group(3)),
+                    user_time=user_time,
+                    sys_time=sys_time,
+                )
+
+        # wait4 gives resource usage of bash and all the commands it has waited for
+        _, status, rusage = os.wait4(proc.pid, 0)
+        finished = True
+
+        # command called exit so the end marker was never printed
+        if running is not None:
+            ret_code = os.WEXITSTATUS(status) if os.WIFEXITED(status) else 1
+            yield RunEvent("exit", running, commands[running], ret_code=ret_code)
+
+        yield RunEvent("finish", -1, "", max_rss=rusage.ru_maxrss)
+    finally:
+        if not finished:
+            os.killpg(proc.pid, signal.SIGKILL)
+            proc.wait()
+        for f in files.values():
+            f.close()
+        os.unlink(script)
+
+
+def _run_pipe(
+    commands: List[str],
+    ignore_errors: bool,
+    print_output: bool,
+    pbar: Optional[tqdm],
+    split_stderr: bool = False,
+) -> Tuple[List[RunResult], Optional[int]]:
+    """
+    Run commands without a pty.
+
+    :return: results and peak resident set size (KiB) of the largest process of the run,
+        bash reports it only for the whole run
+    """
+    results: Dict[int, RunResult] = {}
+    starts: Dict[int, float] = {}
+    max_rss: Optional[int] = None
+
+    for e in _stream_script(commands, not ignore_errors, split_stderr):
+        if e.type == "finish":
+            max_rss = e.max_rss
+            continue
+
+        # stderr is read from a separate pipe so its output might come before the start event
+        result = results.setdefault(e.index, RunResult(command=e.command))
+
+        if e.type == "start":
+            if "PG_DEBUG" in os.environ:
+                logger.debug(e.command)
+            starts[e.index] = time.monotonic()
+        elif e.type == "output":
+            if print_output:
+                sys.stdout.write(e.line)
+            result.output.append(e.line.strip())
+            if e.stream == "stderr":
+                result.stderr_bytes += len(e.line.encode("utf-8"))
+            else:
+                result.stdout_bytes += len(e.line.encode("utf-8"))
+        elif e.type == "exit":
+            end = time.monotonic()
+            tracer.complete(
+                e.command, starts[e.index], end, cat="run", exit_code=e.ret_code
+            )
+            result.exit_code = e.ret_code
+            result.wall_time = end - starts[e.index]
+            result.user_time = e.user_time
+            result.sys_time = e.sys_time
+
+            if pbar and (ignore_errors or not e.ret_code):
+                pbar.update(1)
+
+    return [results[i] for i in sorted(results.keys())], max_rss
+
+
+def _split_commands(command: str) -> List[str]:
     # join multilines
     command = re.sub(r"\\(?:\t| )*\n(?:\t| )*", "", command)
 
     commands: List[str] = [s.strip() for s in command.splitlines() if s.strip()]
+    return commands
 
-    rets: List[str] = []
 
-    prompt = r"##PG_PROMPT##"
+def run_iter(
+    command: str,
+    ignore_errors: bool = False,
+    print_output: bool = False,
+    events: bool = False,
+) -> Iterator[Any]:
+    """
+    Run commands in a bash shell yielding output lines as they arrive.
+
+    Output is not accumulated so memory usage stays constant.
+    Breaking out of the iteration kills commands that are still running.
+    Runs without a pty so it can't be used with commands that need interaction (like sudo).
+
+    :param command: commands separated by new lines
+    :param ignore_errors: if False exit on the first failing command
+    :param print_output: print output while running
+    :param events: yield RunEvent objects (start, output and exit of each command) instead of lines
+    """
+    commands = _split_commands(command)
+
+    for e in _stream_script(commands, stop_on_error=not ignore_errors):
+        if e.type == "start" and "PG_DEBUG" in os.environ:
+            logger.debug(e.command)
+
+        if e.type == "output" and print_output:
+            sys.stdout.write(e.line)
+
+        if events:
+            if e.type != "finish":
+                yield e
+        elif e.type == "output":
+            yield e.line.rstrip("\r\n")
+
+        if e.type == "exit" and not ignore_errors:
+            if e.ret_code:
+                sys.exit(e.ret_code)
 
+
+def _spawn_pty(prompt: str, sudo: bool) -> pexpect.spawn:
     p = pexpect.spawn("bash --rcfile /dev/null", env=os.environ, echo=False)
     p.delaybeforesend = None
 
@@ -57,7 +459,7 @@ def run(
     p.expect(prompt)
 
     # Get sudo password if needed
-    if "sudo " in command:
+    if sudo:
         tries = 3
         while True:
             sudo_password = getpass("Sudo password: ")
@@ -77,40 +479,178 @@ def run(
                 continue
             break
 
-    pbar: tqdm
-    if progress_bar:
-        pbar = tqdm(total=len(commands))
+    return p
+
+
+def _run_pty(
+    p: pexpect.spawn,
+    commands: List[str],
+    prompt: str,
+    ignore_errors: bool,
+    print_output: bool,
+    pbar: Optional[tqdm],
+) -> List[RunResult]:
+    results: List[RunResult] = []
 
     for c in commands:
         if "PG_DEBUG" in os.environ:
             logger.debug(c)
 
+        start = time.monotonic()
         if print_output:
             p.logfile = CustomPrint(command=c, prompt=prompt)
         p.sendline(c)
         p.expect(prompt, timeout=60 * 15)
         if print_output:
             p.logfile = None
+        wall_time = time.monotonic() - start
 
         raw_outputs: List[bytes] = p.before.splitlines()
         outputs: List[str] = [s.decode("utf-8").strip() for s in raw_outputs]
+        stdout_bytes = len(p.before)
         # get exit code
         p.sendline('echo "$?"')
         p.expect(prompt)
         ret_code = int(p.before.splitlines()[0].strip())
+        tracer.complete(c, start, start + wall_time, cat="run", exit_code=ret_code)
 
-        if outputs:
-            ret = "\n".join(outputs)
-            rets.append(ret)
+        result = RunResult(
+            command=c,
+            output=outputs,
+            exit_code=ret_code,
+            wall_time=wall_time,
+            stdout_bytes=stdout_bytes,
+        )
+        results.append(result)
 
-        if not ignore_errors:
-            if ret_code:
-                sys.exit(ret_code)
+        if not ignore_errors and ret_code:
+            break
 
-        if progress_bar:
+        if pbar:
             pbar.update(1)
 
+    return results
+
+
+def _print_summary(results: List[RunResult], max_rss: Optional[int]) -> None:
+    """
+    :param max_rss: peak resident set size (KiB) of the whole run, if known
+    """
+    name_width = 40
+    print(
+        f"{'command':<{name_width}} {'exit':>4} {'wall[s]':>8} {'user[s]':>8} {'sys[s]':>8} "
+        f"{'stdout[B]':>10} {'stderr[B]':>10}"
+    )
+    for r in results:
+        command = r.command
+        if len(command) > name_width:
+            command = command[: name_width - 3] + "..."
+
+        print(
+            f"{command:<{name_width}} {r.exit_code:>4} {r.wall_time:>8.3f} {r.user_time:>8.3f} "
+            f"{r.sys_time:>8.3f} {r.stdout_bytes:>10} {r.stderr_bytes:>10}"
+        )
+
+    if max_rss is not None:
+        print(f"peak rss of the run (largest process): {max_rss} KiB")
+
+
+def run(
+    command: str,
+    ignore_errors: bool = False,
+    print_output: bool = True,
+    progress_bar: bool = False,
+    batch: bool = False,
+    pty: bool = True,
+    results: bool = False,
+) -> List[Any]:
+    """
+    Run commands in a bash shell.
+
+    :param command: commands separated by new lines
+    :param ignore_errors: if False exit on the first failing command
+    :param print_output: print output while running
+    :param progress_bar: show progress bar
+    :param batch: send all commands at once instead of one round trip per command
+    :param pty: run in a pseudo terminal, commands that don't need interaction are faster
+        without it. Commands using sudo always run in a pty
+    :param results: return RunResult objects with exit codes, timings and resource usage
+        instead of outputs. Commands are sent in batch so cpu times can be measured.
+        Summary table is printed when progress_bar is set or PG_DEBUG is in environment
+    :return: outputs of commands
+    """
+    commands = _split_commands(command)
+
+    prompt = r"##PG_PROMPT##"
+
+    sudo = "sudo " in command
+    use_pty = pty or sudo
+
+    if use_pty:
+        p = _spawn_pty(prompt, sudo=sudo)
+
+    pbar: Optional[tqdm] = None
     if progress_bar:
+        pbar = tqdm(total=len(commands))
+
+    max_rss: Optional[int] = None
+    with tracer.span("run", cat="run", commands=len(commands)):
+        if not use_pty:
+            rets, max_rss = _run_pipe(
+                commands, ignore_errors, print_output, pbar, split_stderr=results
+            )
+        elif batch or results:
+            rets = _run_batch(p, commands, prompt, ignore_errors, print_output, pbar)
+        else:
+            rets = _run_pty(p, commands, prompt, ignore_errors, print_output, pbar)
+
+    if pbar:
         pbar.close()
 
-    return rets
+    if results and (progress_bar or "PG_DEBUG" in os.environ):
+        _print_summary(rets, max_rss)
+
+    if not ignore_errors and rets and rets[-1].exit_code:
+        sys.exit(rets[-1].exit_code)
+
+    if results:
+        return rets
+
+    return ["\n".join(r.output) for r in rets if r.output]
+
+
+def run_parallel(
+    commands: Dict[str, str],
+    max_workers: Optional[int] = None,
+    ignore_errors: bool = False,
+    print_output: bool = True,
+) -> Dict[str, List[str]]:
+    """
+    Run independent scripts concurrently, each one in its own bash shell without a pty.
+
+    Printed lines are prefixed with the script name.
+    If any script fails, exits with its exit code after the others finish.
+
+    :param commands: script name to commands mapping, commands are in the same format as in run
+    :param max_workers: max number of scripts running at once, defaults to number of scripts
+    :param ignore_errors: if False exit when any of the scripts fails
+    :param print_output: print output while running
+    :return: script name to outputs mapping
+    """
+
+    def task(script: str) -> Callable[[], List[str]]:
+        return lambda: run(
+            script, ignore_errors=ignore_errors, print_output=print_output, pty=False
+        )
+
+    results = run_dag(
+        {name: task(script) for name, script in commands.items()},
+        max_workers=max_workers,
+    )
+
+    if not ignore_errors:
+        for r in results.values():
+            if r.status == "failed":
+                sys.exit(r.exit_code)
+
+    return {name: r.value or [] for name, r in results.items()}
@@ -1,8 +1,12 @@
 import inspect
+import json
 import os
 import re
 import sys
+import time
 from dataclasses import dataclass, field, fields
+from functools import lru_cache, partial
+from itertools import count
 from pathlib import Path
 from typing import (
     TYPE_CHECKING,
@@ -19,7 +23,19 @@ from typing import (
 
 from loguru import logger
 
-from envo.misc import import_from_file, setup_logger, EnvoError
+from envo.fingerprint import FingerprintStore, TeeOutput
+from envo.jobs import Jobs, jobs
+from envo.metrics import Metrics, metrics
+from envo.misc import (
+    dedupe_paths,
+    import_from_file,
+    setup_logger,
+    write_if_changed,
+    EnvoError,
+)
+from envo.parallel import run_dag
+from envo.profiling import profile
+from envo.trace import tracer
 
 setup_logger()
 
@@ -43,6 +59,9 @@ __all__ = [
 
 T = TypeVar("T")
 
+# variables with colon separated paths, duplicates are removed from them
+path_vars = ["PATH", "PYTHONPATH", "MYPYPATH"]
+
 
 if TYPE_CHECKING:
     Raw = Union[T]
@@ -81,7 +100,13 @@ class MagicFunction:
             args = (self.env, *args)  # type: ignore
         else:
             kwargs["self"] = self.env  # type: ignore
-        return self.func(*args, **kwargs)
+
+        start = time.perf_counter()
+        try:
+            with tracer.span(self.name, cat=self.type):
+                return self.func(*args, **kwargs)
+        finally:
+            metrics.observe(self.type, self.name, (time.perf_counter() - start) * 1000)
 
     def __str__(self) -> str:
         kwargs_str = ", ".join([f"{k}={repr(v)}" for k, v in self.kwargs.items()])
@@ -114,6 +139,36 @@ class MagicFunction:
 
 @dataclass
 class Command(MagicFunction):
+    def __call__(self, *args: Tuple[Any], **kwargs: Dict[str, Any]) -> Any:
+        if self.kwargs.get("background"):
+            return jobs.submit(self, *args, **kwargs)
+
+        return self._call_foreground(*args, **kwargs)
+
+    def _call_foreground(self, *args: Tuple[Any], **kwargs: Dict[str, Any]) -> Any:
+        if self.kwargs.get("profile"):
+            mode = (
+                "cprofile" if self.kwargs["profile"] is True else self.kwargs["profile"]
+            )
+            return profile(self, *args, mode=mode, **kwargs)  # type: ignore
+
+        return self._call(*args, **kwargs)
+
+    def _call(self, *args: Tuple[Any], **kwargs: Dict[str, Any]) -> Any:
+        # force is passed to the function if it defines such argument
+        force = False
+        if "force" in kwargs and "force" not in inspect.signature(self.func).parameters:
+            force = bool(kwargs.pop("force"))
+
+        self._run_deps(force)
+        return self._execute(force, *args, **kwargs)
+
+    def _execute(self, force: bool, *args: Tuple[Any], **kwargs: Dict[str, Any]) -> Any:
+        if "inputs" not in self.kwargs:
+            return super().__call__(*args, **kwargs)
+
+        return self._call_incremental(force, *args, **kwargs)
+
     def __repr__(self) -> str:
         if not self.kwargs["prop"]:
             return super().__repr__()
@@ -122,7 +177,7 @@ class Command(MagicFunction):
         cwd = Path(".").absolute()
         os.chdir(str(self.env.root))
 
-        ret = self.func(self=self.env)
+        ret = self()
 
         os.chdir(str(cwd))
         if ret:
@@ -137,6 +192,95 @@ class Command(MagicFunction):
         """
         pass
 
+    def _run_deps(self, force: bool = False) -> None:
+        """
+        Run dependencies (and their dependencies) concurrently before the command.
+        """
+        if not self.kwargs.get("deps"):
+            return
+
+        assert self.env is not None
+        commands: Dict[str, Command] = {}
+        graph: Dict[str, List[str]] = {}
+
+        def collect(cmd: Command) -> None:
+            for d in cmd.kwargs.get("deps", []):
+                dep = getattr(self.env, d, None)
+                if not isinstance(dep, Command) or d == self.name:
+                    raise EnvoError(f'Invalid dependency "{d}" of command "{cmd.name}"')
+                if d not in commands:
+                    commands[d] = dep
+                    graph[d] = dep.kwargs.get("deps", [])
+                    collect(dep)
+
+        collect(self)
+
+        results = run_dag(
+            {n: partial(c._execute, force) for n, c in commands.items()},
+            graph,
+            max_workers=self.kwargs.get("max_workers"),
+        )
+
+        for r in results.values():
+            if r.status == "failed":
+                assert r.error
+                raise r.error
+
+    def _call_incremental(
+        self, force: bool, *args: Tuple[Any], **kwargs: Dict[str, Any]
+    ) -> Any:
+        """
+        Skip the command and replay its previous output if inputs didn't change.
+
+        Inputs are files matching input globs, env variables, command source and arguments.
+        Command is rerun also when files matching output globs changed.
+        """
+        assert self.env is not None
+        store = FingerprintStore(self.env.root)
+        key = f"{self.env.meta.stage}.{self.name}"
+        inputs: List[str] = self.kwargs["inputs"]
+        outputs: List[str] = self.kwargs.get("outputs", [])
+        extra = [
+            inspect.getsource(self.func),
+            json.dumps(self.env.get_env_vars(), sort_keys=True),
+            repr(args),
+            repr(sorted(kwargs.items())),
+        ]
+
+        entry = store.get(key)
+        if (
+            not force
+            and entry
+            and entry["inputs"] == store.fingerprint(inputs, extra)
+            and entry["outputs"] == store.fingerprint(outputs, [])
+        ):
+            logger.info(
+                f'Inputs of "{self.name}" unchanged, skipping (use force=True to run anyway)'
+            )
+            sys.stdout.write(entry["output"])
+            return entry["ret"]
+
+        with TeeOutput() as out:
+            ret = super().__call__(*args, **kwargs)
+
+        try:
+            json.dumps(ret)
+        except TypeError:
+            # can't replay return values that are not serializable
+            return ret
+
+        # fingerprint computed after the run in case the command modified its inputs (like black)
+        store.put(
+            key,
+            {
+                "inputs": store.fingerprint(inputs, extra),
+                "outputs": store.fingerprint(outputs, []),
+                "output": out.getvalue(),
+                "ret": ret,
+            },
+        )
+        return ret
+
 
 class magic_function:  # noqa: N801
     klass = MagicFunction
@@ -182,8 +326,40 @@ class command(magic_function):  # noqa: N801
     klass = Command
     default_kwargs = {"glob": True, "prop": True}
 
-    def __init__(self, glob: bool = True, prop: bool = True) -> None:
-        super().__init__(glob=glob, prop=prop)  # type: ignore
+    def __init__(
+        self,
+        glob: bool = True,
+        prop: bool = True,
+        deps: Optional[List[str]] = None,
+        max_workers: Optional[int] = None,
+        inputs: Optional[List[str]] = None,
+        outputs: Optional[List[str]] = None,
+        profile: Union[bool, str] = False,
+        background: bool = False,
+    ) -> None:
+        """
+        :param deps: names of commands to run (concurrently) before this one
+        :param max_workers: max number of dependencies running at once
+        :param inputs: file globs (relative to env root), when set the command is skipped
+            and its previous output replayed if inputs didn't change. Pass force=True to run anyway
+        :param outputs: file globs of files created by the command, command is rerun if they change
+        :param profile: run under a profiler, True or "cprofile" for cProfile, "sample" for sampling profiler
+        :param background: run in a worker process and return a job handle right away (see envo.jobs)
+        """
+        kwargs: Dict[str, Any] = {"glob": glob, "prop": prop}
+        if deps:
+            kwargs["deps"] = deps
+        if max_workers:
+            kwargs["max_workers"] = max_workers
+        if inputs is not None:
+            kwargs["inputs"] = inputs
+        if outputs:
+            kwargs["outputs"] = outputs
+        if profile:
+            kwargs["profile"] = profile
+        if background:
+            kwargs["background"] = background
+        super().__init__(**kwargs)
 
 
 class event(magic_function):  # noqa: N801
@@ -210,21 +386,177 @@ class onunload(event):  # noqa: N801
 class cmd_hook(magic_function):  # noqa: N801
     default_kwargs = {"cmd_regex": ".*"}
 
-    def __init__(self, cmd_regex: str = ".*") -> None:
-        super().__init__(cmd_regex=cmd_regex)  # type: ignore
+    def __init__(
+        self,
+        cmd_regex: str = ".*",
+        budget_ms: Optional[float] = None,
+        demote: Optional[str] = None,
+    ) -> None:
+        """
+        :param cmd_regex: run hook only for commands matching this regex
+        :param budget_ms: latency budget, hook is demoted if it keeps exceeding it
+            (defaults to Meta.hook_budget_ms)
+        :param demote: "disable" to let a slow hook be disabled for the session,
+            hooks rewriting commands or output are only warned about otherwise
+        """
+        kwargs: Dict[str, Any] = {"cmd_regex": cmd_regex}
+        if budget_ms is not None:
+            kwargs["budget_ms"] = budget_ms
+        if demote is not None:
+            if demote != "disable":
+                raise EnvoError(f'Unknown demote "{demote}", expected "disable"')
+            kwargs["demote"] = demote
+        super().__init__(**kwargs)
 
 
 class precmd(cmd_hook):  # noqa: N801
     expected_fun_args = ["command"]
 
 
-class onstdout(cmd_hook):  # noqa: N801
-    expected_fun_args = ["command", "out"]
+# keeps substitution hooks in declaration order
+_sub_hooks_counter = count()
+
+
+@dataclass
+class SubHook(MagicFunction):
+    """
+    Output hook replacing regex matches, created with onstdout.sub and onstderr.sub.
+    """
+
+    def __post_init__(self) -> None:
+        self.decl = f"sub({self.kwargs['pattern']!r}, {self.kwargs['repl']!r})"
+        self.regex = re.compile(self.kwargs["pattern"])
+        self.order = next(_sub_hooks_counter)
+
+    def __set_name__(self, owner: Any, name: str) -> None:
+        self.name = name
+
+
+# unescaped numbered backreference (\\1) or conditional group ((?(1)...))
+_group_ref = re.compile(r"(?<!\\)(?:\\\\)*(?:\\[1-9]|\(\?\()")
+
+
+class Substitutions:
+    """
+    Substitution hooks of a command merged into a single regex.
 
+    At each position patterns are tried in the order hooks were declared.
+    Patterns that can't be merged (eg. duplicated group names or numbered backreferences)
+    are applied one after another.
+    """
+
+    def __init__(self, hooks: List[SubHook]) -> None:
+        self.hooks = sorted(hooks, key=lambda h: h.order)
+        self.transform = lru_cache(maxsize=256)(self._compile)
+
+    def __call__(self, command: str, out: str) -> str:
+        if not self.hooks:
+            return out
+
+        transform = self.transform(command)
+        return transform(out) if transform else out
+
+    def _compile(self, command: str) -> Optional[Callable[[str], str]]:
+        hooks = [h for h in self.hooks if re.match(h.kwargs["cmd_regex"], command)]
+        if not hooks:
+            return None
+
+        if len(hooks) == 1:
+            return partial(hooks[0].regex.sub, hooks[0].kwargs["repl"])
+
+        try:
+            # merging renumbers groups, patterns referring to them by number would break
+            if any(_group_ref.search(h.kwargs["pattern"]) for h in hooks):
+                raise re.error("numbered group reference")
+            merged = re.compile(
+                "|".join(
+                    f"(?P<_sub{i}>{h.kwargs['pattern']})" for i, h in enumerate(hooks)
+                )
+            )
+        except re.error:
+            subs = [partial(h.regex.sub, h.kwargs["repl"]) for h in hooks]
+
+            def sequential(out: str) -> str:
+                for sub in subs:
+                    out = sub(out)
+                return out
+
+            return sequential
+
+        def replace(match: Any) -> str:
+            hook = hooks[int(match.lastgroup[4:])]
+            repl = hook.kwargs["repl"]
+            if isinstance(repl, str) and "\\" not in repl:
+                return repl
 
-class onstderr(cmd_hook):  # noqa: N801
+            # match again with hook's own pattern so group numbers are the ones it expects
+            hook_match = hook.regex.match(match.string, match.start())
+            assert hook_match
+            return str(repl(hook_match) if callable(repl) else hook_match.expand(repl))
+
+        return partial(merged.sub, replace)
+
+
+class output_hook(cmd_hook):  # noqa: N801
     expected_fun_args = ["command", "out"]
 
+    def __init__(
+        self,
+        cmd_regex: str = ".*",
+        budget_ms: Optional[float] = None,
+        demote: Optional[str] = None,
+        tee: bool = False,
+    ) -> None:
+        """
+        :param tee: also pass output of subprocesses (like kubectl or pytest) through the hook,
+            it's captured through a pty for the whole command (see envo.tee)
+        """
+        super().__init__(cmd_regex=cmd_regex, budget_ms=budget_ms, demote=demote)
+        if tee:
+            self.kwargs["tee"] = True  # type: ignore
+
+    @classmethod
+    def sub(
+        cls,
+        pattern: str,
+        repl: Union[str, Callable],
+        cmd_regex: str = ".*",
+        tee: bool = False,
+    ) -> SubHook:
+        """
+        Declare hook replacing pattern matches in output, same as re.sub does.
+
+        Substitutions are applied before regular hooks and they're merged into a single regex pass.
+
+        :param repl: replacement string or function taking re.Match
+        :param cmd_regex: replace only in output of commands matching this regex
+        :param tee: also replace in output of subprocesses
+        """
+
+        def func(self: Any, command: str, out: str) -> str:
+            return re.sub(pattern, repl, out)
+
+        return SubHook(
+            name=func.__name__,
+            type=cls.__name__,
+            func=func,
+            kwargs={
+                "cmd_regex": cmd_regex,
+                "pattern": pattern,
+                "repl": repl,
+                "tee": tee,
+            },
+            expected_fun_args=cls.expected_fun_args,
+        )
+
+
+class onstdout(output_hook):  # noqa: N801
+    pass
+
+
+class onstderr(output_hook):  # noqa: N801
+    pass
+
 
 class postcmd(cmd_hook):  # noqa: N801
     expected_fun_args = ["command", "stdout", "stderr"]
@@ -380,7 +712,12 @@ class BaseEnv(metaclass=EnvMetaclass):
                 else:
                     var_name = namespace + f.name.replace("_", "").upper()
 
-                envs[var_name] = str(f.value)
+                value = str(f.value)
+                # parent envs and nested activations prepend to the same variables
+                if var_name in path_vars:
+                    value = ":".join(dedupe_paths(value.split(":")))
+
+                envs[var_name] = value
 
         return envs
 
@@ -418,6 +755,7 @@ class Env(BaseEnv):
         root: Path = field(init=False)
         parent: Optional[str] = field(default=None, init=False)
         version: str = field(default="0.1.0", init=False)
+        hook_budget_ms: Optional[float] = field(default=None, init=False)
 
     root: Path
     stage: str
@@ -459,6 +797,12 @@ class Env(BaseEnv):
             "onunload": [],
         }
         self._collect_commands_and_hooks()
+        self._substitutions = {
+            t: Substitutions(
+                [h for h in self._magic_functions[t] if isinstance(h, SubHook)]
+            )
+            for t in ["onstdout", "onstderr"]
+        }
 
         if self.meta.parent:
             self._init_parent()
@@ -478,18 +822,36 @@ class Env(BaseEnv):
     def get_magic_functions(self) -> Dict[str, List[MagicFunction]]:
         return self._magic_functions
 
+    def get_substitutions(self, type: str) -> "Substitutions":
+        """
+        :param type: "onstdout" or "onstderr"
+        """
+        return self._substitutions[type]
+
+    def stats(self) -> Metrics:
+        """
+        Return latencies of commands and hooks called in this process.
+        """
+        return metrics
+
+    def jobs(self) -> Jobs:
+        """
+        Return commands running in background workers.
+        """
+        return jobs
+
     def dump_dot_env(self) -> None:
         """
         Dump .env file for the current environment.
 
         File name follows env_{env_name} format.
         """
-        self.activate()
+        self.validate()
         path = Path(f".env_{self.meta.stage}")
         content = "\n".join(
             [f'{key}="{value}"' for key, value in self.get_env_vars().items()]
         )
-        path.write_text(content)
+        write_if_changed(path, content)
         logger.info(f"Saved envs to {str(path)} 💾")
 
     def get_full_name(self) -> str:
@@ -586,8 +948,16 @@ class Env(BaseEnv):
 
         env_dir = self.root.parents[len(self.meta.parent) - 2].absolute()
         sys.path.insert(0, str(env_dir))
-        self._parent = import_from_file(env_dir / f"env_{self.stage}.py").Env()
-        sys.path.pop(0)
+        try:
+            self._parent = import_from_file(env_dir / f"env_{self.stage}.py").Env()
+        finally:
+            # parent might have added its own paths (venv) so it's removed by value
+            sys.path.remove(str(env_dir))
+            # parent env modules are referenced by the parent, keeping them in sys.modules
+            # would keep them alive until the next reload
+            for m in list(sys.modules.keys())[:]:
+                if m.startswith("env_"):
+                    sys.modules.pop(m)
         assert self._parent
         self._parent.activate()
 
@@ -622,4 +992,5 @@ class VenvEnv(BaseEnv):
             next((self._owner.root / ".venv/lib").glob("*")) / "site-packages"
         )
 
-        sys.path.insert(0, str(site_packages))
+        if str(site_packages) not in sys.path:
+            sys.path.insert(0, str(site_packages))
@@ -0,0 +1,131 @@
+import hashlib
+import json
+from pathlib import Path
+from threading import Lock
+from typing import Any, Dict, List, Optional, Tuple
+
+from envo.misc import write_atomic
+from envo.parallel import OutputWriter
+
+__all__ = ["FingerprintStore", "TeeOutput"]
+
+
+class TeeOutput(OutputWriter):
+    """
+    Keep a copy of what the current thread writes to stdout.
+
+    Captures of threads running concurrently (like dependencies in run_dag) get only their own output.
+    """
+
+    def __init__(self) -> None:
+        self.output: List[str] = []
+
+    def __enter__(self) -> "TeeOutput":
+        super().__enter__()
+        return self
+
+    def write(self, text: str) -> str:
+        self.output.append(text)
+        return text
+
+    def getvalue(self) -> str:
+        return "".join(self.output)
+
+
+class FingerprintStore:
+    """
+    Local store of command fingerprints kept in {root}/.envo/fingerprints.json.
+
+    File hashes are cached by modification time and size so unchanged files are not read again.
+    The file is shared by envo processes of the project (like git hooks running in parallel),
+    it's updated under an inter-process lock and only when something changed.
+    """
+
+    _lock = Lock()
+
+    def __init__(self, root: Path) -> None:
+        self.path = root / ".envo" / "fingerprints.json"
+        self.root = root
+
+    def _load(self) -> Dict[str, Any]:
+        if not self.path.exists():
+            return {"commands": {}, "files": {}}
+        try:
+            data: Dict[str, Any] = json.loads(self.path.read_text())
+            return data
+        except ValueError:
+            return {"commands": {}, "files": {}}
+
+    def _save(self, data: Dict[str, Any]) -> None:
+        # hashes of removed files would be kept forever
+        data["files"] = {k: v for k, v in data["files"].items() if Path(k).exists()}
+        write_atomic(self.path, json.dumps(data))
+
+    def _hash_file(self, path: Path, files: Dict[str, List[Any]]) -> Tuple[str, bool]:
+        """
+        :return: hash and True if it wasn't cached
+        """
+        stat = path.stat()
+        key = str(path)
+        cached = files.get(key)
+        if cached and cached[0] == stat.st_mtime_ns and cached[1] == stat.st_size:
+            return str(cached[2]), False
+
+        digest = hashlib.sha256()
+        with path.open("rb") as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                digest.update(chunk)
+
+        files[key] = [stat.st_mtime_ns, stat.st_size, digest.hexdigest()]
+        return digest.hexdigest(), True
+
+    def hash_globs(
+        self, globs: List[str], files: Dict[str, List[Any]]
+    ) -> Tuple[str, bool]:
+        """
+        :return: hash of files and True if any of them wasn't cached
+        """
+        digest = hashlib.sha256()
+        changed = False
+        paths = sorted({p for g in globs for p in self.root.glob(g) if p.is_file()})
+        for p in paths:
+            file_digest, file_changed = self._hash_file(p, files)
+            changed |= file_changed
+            digest.update(str(p.relative_to(self.root)).encode("utf-8"))
+            digest.update(file_digest.encode("utf-8"))
+        return digest.hexdigest(), changed
+
+    def fingerprint(self, globs: List[str], extra: List[str]) -> str:
+        """
+        Compute fingerprint of files matching globs and extra values.
+        """
+        from ilock import ILock
+
+        with self._lock:
+            data = self._load()
+            files_digest, changed = self.hash_globs(globs, data["files"])
+            if changed:
+                with ILock("envo_fingerprints_lock"):
+                    # other processes might have saved their hashes in the meantime
+                    saved = self._load()
+                    saved["files"].update(data["files"])
+                    self._save(saved)
+
+            digest = hashlib.sha256()
+            digest.update(files_digest.encode("utf-8"))
+            for e in extra:
+                digest.update(e.encode("utf-8"))
+            return digest.hexdigest()
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            ret: Optional[Dict[str, Any]] = self._load()["commands"].get(key)
+            return ret
+
+    def put(self, key: str, entry: Dict[str, Any]) -> None:
+        from ilock import ILock
+
+        with self._lock, ILock("envo_fingerprints_lock"):
+            data = self._load()
+            data["commands"][key] = entry
+            self._save(data)
@@ -0,0 +1,132 @@
+import time
+from dataclasses import dataclass
+from threading import Lock, Thread
+from typing import Any, Dict, Optional
+
+from loguru import logger
+
+from envo.env import MagicFunction
+
+__all__ = ["HookStats", "HookGuard"]
+
+
+@dataclass
+class HookStats:
+    """
+    Timing of a hook, status is one of "active", "async" or "disabled".
+    """
+
+    name: str
+    type: str
+    budget_ms: Optional[float] = None
+    demote: Optional[str] = None
+    calls: int = 0
+    total_ms: float = 0.0
+    max_ms: float = 0.0
+    over_budget: int = 0
+    status: str = "active"
+
+
+class HookGuard:
+    """
+    Call hooks measuring their time against latency budgets.
+
+    Hook exceeding its budget warn_after times in a row is warned about.
+    After demote_after times it's demoted for the session: hooks which don't return anything (postcmd)
+    are moved to background threads, hooks declared with demote="disable" are disabled.
+    Other hooks rewrite commands or output (eg. masking secrets) so they're only warned about.
+    Demotion is kept across reloads since hooks are tracked by name.
+    """
+
+    warn_after = 3
+    demote_after = 5
+
+    def __init__(self) -> None:
+        self.hooks: Dict[str, HookStats] = {}
+        self._lock = Lock()
+
+    def call(
+        self, hook: MagicFunction, budget_ms: Optional[float], **kwargs: Any
+    ) -> Any:
+        """
+        Call hook if it's not disabled.
+
+        :param budget_ms: used if hook doesn't define its own budget
+        :return: hook return value, None if hook is disabled or runs in background
+        """
+        with self._lock:
+            if hook.name not in self.hooks:
+                self.hooks[hook.name] = HookStats(name=hook.name, type=hook.type)
+            stats = self.hooks[hook.name]
+            stats.budget_ms = hook.kwargs.get("budget_ms", budget_ms)
+            stats.demote = hook.kwargs.get("demote")
+
+        if stats.status == "disabled":
+            return None
+
+        if stats.status == "async":
+            Thread(target=hook, kwargs=kwargs, daemon=True).start()
+            return None
+
+        start = time.perf_counter()
+        try:
+            return hook(**kwargs)
+        finally:
+            self._record(stats, (time.perf_counter() - start) * 1000)
+
+    def _record(self, stats: HookStats, duration_ms: float) -> None:
+        with self._lock:
+            stats.calls += 1
+            stats.total_ms += duration_ms
+            stats.max_ms = max(stats.max_ms, duration_ms)
+
+            if stats.budget_ms is None or duration_ms <= stats.budget_ms:
+                stats.over_budget = 0
+                return
+
+            stats.over_budget += 1
+            if stats.over_budget == self.warn_after:
+                logger.warning(
+                    f'Hook "{stats.name}" took {duration_ms:.0f} ms, '
+                    f"over its {stats.budget_ms:g} ms budget {stats.over_budget} times in a row"
+                )
+
+            status = self._demoted_status(stats)
+            if stats.over_budget >= self.demote_after and status:
+                stats.status = status
+                logger.warning(
+                    f'Hook "{stats.name}" is too slow, {stats.status} for this session '
+                    f'(hooks.enable("{stats.name}") to re-enable)'
+                )
+
+    @staticmethod
+    def _demoted_status(stats: HookStats) -> Optional[str]:
+        if stats.demote == "disable":
+            return "disabled"
+        if stats.type == "postcmd":
+            return "async"
+        return None
+
+    def enable(self, name: str) -> None:
+        """
+        Re-enable demoted hook.
+        """
+        with self._lock:
+            stats = self.hooks[name]
+            stats.status = "active"
+            stats.over_budget = 0
+
+    def demoted(self) -> Dict[str, HookStats]:
+        return {n: s for n, s in self.hooks.items() if s.status != "active"}
+
+    def __repr__(self) -> str:
+        lines = [
+            f"{'hook':<24}{'type':<10}{'status':<10}{'calls':>7}{'avg ms':>9}{'max ms':>9}{'budget':>8}"
+        ]
+        for s in self.hooks.values():
+            avg_ms = s.total_ms / s.calls if s.calls else 0.0
+            budget = f"{s.budget_ms:g}" if s.budget_ms is not None else "-"
+            lines.append(
+                f"{s.name:<24}{s.type:<10}{s.status:<10}{s.calls:>7}{avg_ms:>9.1f}{s.max_ms:>9.1f}{budget:>8}"
+            )
+        return "\n".join(lines)
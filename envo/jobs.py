@@ -0,0 +1,298 @@
+import os
+import pickle
+import select
+import signal
+import sys
+import time
+from dataclasses import dataclass, field
+from itertools import count
+from threading import BoundedSemaphore, Condition, Lock, Thread
+from typing import TYPE_CHECKING, Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+from envo.misc import LineBuffer, forked_worker
+
+if TYPE_CHECKING:
+    from envo.env import Command
+
+__all__ = ["Job", "Jobs", "jobs", "bg"]
+
+
+@dataclass
+class Job:
+    """
+    Handle of a command running in a background worker process.
+
+    status is one of "pending" (waiting for a free worker), "running", "done" or "failed".
+    Output lines are appended to output as they're printed.
+    """
+
+    id: int
+    name: str
+    status: str = "pending"
+    pid: Optional[int] = None
+    output: List[str] = field(default_factory=list)
+    result: Any = None
+    error: Optional[str] = None
+    exit_code: Optional[int] = None
+    wall_time: float = 0.0
+    _changed: Condition = field(default_factory=Condition, repr=False)
+
+    @property
+    def done(self) -> bool:
+        return self.status in ["done", "failed"]
+
+    def wait(self, timeout_s: Optional[float] = None) -> Any:
+        """
+        Wait for the job to finish.
+
+        :return: command return value, None if the job failed or didn't finish in time
+        """
+        with self._changed:
+            self._changed.wait_for(lambda: self.done, timeout_s)
+        return self.result
+
+    def follow(self) -> Iterator[str]:
+        """
+        Iterate over output lines, new lines are waited for until the job finishes.
+        """
+        i = 0
+        while True:
+            with self._changed:
+                self._changed.wait_for(lambda: self.done or i < len(self.output))
+                lines = self.output[i:]
+                done = self.done
+            i += len(lines)
+            yield from lines
+            if done:
+                return
+
+    def kill(self, sig: int = signal.SIGTERM) -> None:
+        if self.pid and not self.done:
+            try:
+                os.killpg(self.pid, sig)
+            except ProcessLookupError:
+                pass
+
+    def __repr__(self) -> str:
+        ret = f"[{self.id}] {self.name} {self.status}"
+        if self.error:
+            ret += f" ({self.error})"
+        elif self.exit_code:
+            ret += f" (exit code {self.exit_code})"
+        return ret
+
+
+class Jobs:
+    """
+    Run commands in forked worker processes, so the shell can be used while they run.
+
+    A worker is forked for every job so it sees the current env, commands and variables,
+    at most max_workers jobs run at once, the rest are pending.
+    """
+
+    def __init__(self, max_workers: Optional[int] = None) -> None:
+        self.max_workers = max_workers or os.cpu_count() or 1
+        self.jobs: Dict[int, Job] = {}
+        # called when a job starts or finishes
+        self.on_change: Optional[Callable[[Job], None]] = None
+        # variables workers run with, defaults to os.environ
+        self.get_environ: Optional[Callable[[], Dict[str, str]]] = None
+        self._ids = count(1)
+        self._lock = Lock()
+        self._workers = BoundedSemaphore(self.max_workers)
+        # workers mustn't inherit pipes of other workers, they'd never get EOF
+        self._fork_lock = Lock()
+
+    @property
+    def running(self) -> int:
+        """
+        Number of pending and running jobs.
+        """
+        with self._lock:
+            return sum(not j.done for j in self.jobs.values())
+
+    def submit(self, cmd: "Command", *args: Any, **kwargs: Any) -> Job:
+        """
+        Run command in a worker process.
+
+        :return: job handle, available through env.jobs() too
+        """
+        return self.start(cmd.name, cmd._call_foreground, *args, **kwargs)
+
+    def start(self, name: str, func: Callable, *args: Any, **kwargs: Any) -> Job:
+        """
+        Call function in a worker process.
+
+        :param name: job name
+        :return: job handle
+        """
+        environ = dict(self.get_environ() if self.get_environ else os.environ)
+        with self._lock:
+            job = Job(id=next(self._ids), name=name)
+            self.jobs[job.id] = job
+
+        Thread(
+            target=self._run,
+            args=(job, func, args, kwargs, environ),
+            name=f"envo-job-{job.id}",
+            daemon=True,
+        ).start()
+        return job
+
+    def kill(self) -> None:
+        """
+        Kill all running jobs.
+        """
+        for j in list(self.jobs.values()):
+            j.kill()
+
+    def clear(self) -> None:
+        """
+        Forget finished jobs.
+        """
+        with self._lock:
+            self.jobs = {i: j for i, j in self.jobs.items() if not j.done}
+
+    def _run(
+        self,
+        job: Job,
+        func: Callable,
+        args: Tuple[Any, ...],
+        kwargs: Dict[str, Any],
+        environ: Dict[str, str],
+    ) -> None:
+        with self._workers:
+            start = time.monotonic()
+            with self._fork_lock:
+                devnull = os.open(os.devnull, os.O_RDONLY)
+                out_read, out_write = os.pipe()
+                result_read, result_write = os.pipe()
+
+                sys.stdout.flush()
+                sys.stderr.flush()
+                pid = os.fork()
+                if pid == 0:
+                    os.close(out_read)
+                    os.close(result_read)
+                    _worker(
+                        func, args, kwargs, environ, devnull, out_write, result_write
+                    )
+
+                os.close(devnull)
+                os.close(out_write)
+                os.close(result_write)
+
+            with job._changed:
+                job.pid = pid
+                job.status = "running"
+            self._notify(job)
+
+            payload = self._read(job, out_read, result_read)
+
+            _, status = os.waitpid(pid, 0)
+            code = (
+                128 + os.WTERMSIG(status)
+                if os.WIFSIGNALED(status)
+                else os.WEXITSTATUS(status)
+            )
+            wall_time = time.monotonic() - start
+
+        try:
+            result = pickle.loads(payload) if payload else {}
+        except Exception as e:
+            result = {"error": f"Couldn't load result ({e})"}
+
+        with job._changed:
+            job.exit_code = code
+            job.wall_time = wall_time
+            job.result = result.get("result")
+            job.error = result.get("error")
+            job.status = "done" if code == 0 else "failed"
+            job._changed.notify_all()
+        self._notify(job)
+
+    def _read(self, job: Job, out_read: int, result_read: int) -> bytes:
+        """
+        Collect output lines of a worker until it exits.
+
+        :return: pickled result
+        """
+        lines = LineBuffer("replace")
+        result = b""
+        fds = [out_read, result_read]
+        while fds:
+            ready, _, _ = select.select(fds, [], [])
+            for fd in ready:
+                data = os.read(fd, 64 * 1024)
+                if not data:
+                    fds.remove(fd)
+                    os.close(fd)
+                elif fd == result_read:
+                    result += data
+                else:
+                    new_lines = lines.feed(data)
+                    with job._changed:
+                        job.output.extend(line.rstrip("\r\n") for line in new_lines)
+                        job._changed.notify_all()
+
+        pending = lines.take_pending()
+        if pending:
+            with job._changed:
+                job.output.append(pending)
+        return result
+
+    def _notify(self, job: Job) -> None:
+        if self.on_change:
+            self.on_change(job)
+
+    def __repr__(self) -> str:
+        with self._lock:
+            return "\n".join(repr(j) for j in self.jobs.values())
+
+
+def _worker(
+    func: Callable,
+    args: Tuple[Any, ...],
+    kwargs: Dict[str, Any],
+    environ: Dict[str, str],
+    devnull: int,
+    out_write: int,
+    result_write: int,
+) -> None:
+    result: Dict[str, Any] = {}
+
+    def send_result(error: Optional[BaseException]) -> None:
+        if error:
+            result["error"] = f"{type(error).__name__}: {error}"
+        try:
+            payload = pickle.dumps(result)
+        except Exception:
+            payload = pickle.dumps(
+                {"result": repr(result.get("result")), "error": result.get("error")}
+            )
+        data = memoryview(payload)
+        while data:
+            written = os.write(result_write, data)
+            data = data[written:]
+
+    with forked_worker(
+        [devnull, out_write, out_write],
+        environ,
+        [signal.SIGINT, signal.SIGTERM],
+        send_result,
+    ):
+        # own process group so ctrl-c in the shell doesn't interrupt the job
+        os.setpgid(0, 0)
+        result["result"] = func(*args, **kwargs)
+
+
+jobs = Jobs()
+
+
+def bg(cmd: "Command", *args: Any, **kwargs: Any) -> Job:
+    """
+    Run command in a background worker process.
+
+    :return: job handle, job.wait() returns the command result
+    """
+    return jobs.submit(cmd, *args, **kwargs)
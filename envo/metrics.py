@@ -0,0 +1,184 @@
+import json
+from bisect import bisect_left
+from dataclasses import dataclass, field
+from pathlib import Path
+from threading import Lock
+from typing import Dict, List, Tuple
+
+from envo.misc import write_atomic
+
+__all__ = ["Histogram", "Metrics", "metrics"]
+
+
+# upper bounds of histogram buckets in milliseconds
+buckets_ms: Tuple[float, ...] = (
+    0.1,
+    0.5,
+    1,
+    2.5,
+    5,
+    10,
+    25,
+    50,
+    100,
+    250,
+    500,
+    1000,
+    2500,
+    5000,
+    10000,
+    30000,
+    60000,
+)
+
+
+@dataclass
+class Histogram:
+    """
+    Latency histogram with fixed buckets (last bucket is +Inf).
+    """
+
+    counts: List[int] = field(default_factory=lambda: [0] * (len(buckets_ms) + 1))
+    count: int = 0
+    total_ms: float = 0.0
+    max_ms: float = 0.0
+
+    def observe(self, duration_ms: float) -> None:
+        self.counts[bisect_left(buckets_ms, duration_ms)] += 1
+        self.count += 1
+        self.total_ms += duration_ms
+        self.max_ms = max(self.max_ms, duration_ms)
+
+    def percentile(self, q: float) -> float:
+        """
+        Estimate percentile as upper bound of the bucket it falls into.
+        """
+        cumulative = 0
+        for i, c in enumerate(self.counts):
+            cumulative += c
+            if c and cumulative >= q * self.count:
+                return (
+                    min(buckets_ms[i], self.max_ms)
+                    if i < len(buckets_ms)
+                    else self.max_ms
+                )
+        return 0.0
+
+    def merge(self, other: "Histogram") -> None:
+        self.counts = [a + b for a, b in zip(self.counts, other.counts)]
+        self.count += other.count
+        self.total_ms += other.total_ms
+        self.max_ms = max(self.max_ms, other.max_ms)
+
+
+class Metrics:
+    """
+    Registry of magic functions (commands, hooks, contexts) latencies.
+    """
+
+    def __init__(self) -> None:
+        self.histograms: Dict[Tuple[str, str], Histogram] = {}
+        self._lock = Lock()
+
+    def observe(self, type: str, name: str, duration_ms: float) -> None:
+        with self._lock:
+            if (type, name) not in self.histograms:
+                self.histograms[(type, name)] = Histogram()
+            self.histograms[(type, name)].observe(duration_ms)
+
+    def clear(self) -> None:
+        with self._lock:
+            self.histograms = {}
+
+    def merge(self, other: "Metrics") -> None:
+        with self._lock:
+            for key, h in other.histograms.items():
+                if key not in self.histograms:
+                    self.histograms[key] = Histogram()
+                self.histograms[key].merge(h)
+
+    def to_json(self) -> str:
+        return json.dumps(
+            [
+                {"type": t, "name": n, **h.__dict__}
+                for (t, n), h in sorted(self.histograms.items())
+            ],
+            indent=2,
+        )
+
+    @classmethod
+    def from_json(cls, content: str) -> "Metrics":
+        ret = cls()
+        for d in json.loads(content):
+            key = (d.pop("type"), d.pop("name"))
+            ret.histograms[key] = Histogram(**d)
+        return ret
+
+    def to_prometheus(self) -> str:
+        metric = "envo_magic_function_duration_ms"
+        lines = [
+            f"# HELP {metric} Duration of envo commands and hooks.",
+            f"# TYPE {metric} histogram",
+        ]
+        for (t, n), h in sorted(self.histograms.items()):
+            labels = f'type="{t}",name="{n}"'
+            cumulative = 0
+            for bound, c in zip([*buckets_ms, "+Inf"], h.counts):
+                cumulative += c
+                lines.append(f'{metric}_bucket{{{labels},le="{bound}"}} {cumulative}')
+            lines.append(f"{metric}_sum{{{labels}}} {h.total_ms}")
+            lines.append(f"{metric}_count{{{labels}}} {h.count}")
+        return "\n".join(lines) + "\n"
+
+    def save(self, path: Path) -> "Metrics":
+        """
+        Merge metrics into a JSON file.
+
+        :return: merged metrics
+        """
+        from ilock import ILock
+
+        with ILock("envo_metrics_lock"):
+            data = Metrics.load(path)
+            data.merge(self)
+            data.export(path)
+
+        return data
+
+    @classmethod
+    def load(cls, path: Path) -> "Metrics":
+        """
+        Load metrics from a JSON file, empty metrics if file doesn't exist or is corrupted.
+        """
+        if not path.exists():
+            return cls()
+
+        try:
+            return cls.from_json(path.read_text())
+        except (ValueError, TypeError, KeyError):
+            return cls()
+
+    def export(self, path: Path) -> None:
+        """
+        Write metrics to a file, Prometheus text format if suffix is .prom, JSON otherwise.
+        """
+        write_atomic(
+            path, self.to_prometheus() if path.suffix == ".prom" else self.to_json()
+        )
+
+    def __repr__(self) -> str:
+        lines = [
+            f"{'type':<10}{'name':<24}{'calls':>7}{'p50 ms':>9}{'p95 ms':>9}{'max ms':>9}{'total ms':>11}"
+        ]
+        for (t, n), h in sorted(self.histograms.items()):
+            lines.append(
+                f"{t:<10}{n:<24}{h.count:>7}{h.percentile(0.5):>9.1f}{h.percentile(0.95):>9.1f}"
+                f"{h.max_ms:>9.1f}{h.total_ms:>11.1f}"
+            )
+        return "\n".join(lines)
+
+    def __bool__(self) -> bool:
+        return bool(self.histograms)
+
+
+metrics = Metrics()
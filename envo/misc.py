@@ -1,16 +1,35 @@
+import codecs
 import importlib.machinery
 import importlib.util
 import inspect
+import os
+import signal
 import sys
+from contextlib import contextmanager
 from pathlib import Path
-from typing import Any, Dict
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Sequence,
+    Union,
+)
 
 __all__ = [
     "dir_name_to_class_name",
     "setup_logger",
+    "forked_worker",
     "render_py_file",
     "render_file",
     "import_from_file",
+    "write_if_changed",
+    "write_atomic",
+    "dedupe_paths",
+    "LineBuffer",
     "EnvoError",
 ]
 
@@ -76,6 +95,61 @@ def setup_logger() -> None:
     )
 
 
+@contextmanager
+def forked_worker(
+    fds: Sequence[int],
+    environ: Dict[str, str],
+    signals: Iterable[int],
+    on_exit: Optional[Callable[[Optional[BaseException]], None]] = None,
+) -> Iterator[None]:
+    """
+    Turn a freshly forked process into a worker and exit it when the block ends.
+
+    The process exits with 0, with the SystemExit code or with 1 if the block raised
+    (the traceback is printed). It never returns to the code that forked it.
+
+    :param fds: descriptors to use as stdin, stdout and stderr, they're closed afterwards
+    :param environ: variables to replace os.environ with
+    :param signals: signals inherited handlers of are reset to defaults
+    :param on_exit: called right before exiting, with the exception if the block raised one
+    """
+    code = 1
+    error: Optional[BaseException] = None
+    try:
+        for i, fd in enumerate(fds):
+            os.dup2(fd, i)
+        for fd in set(fds):
+            os.close(fd)
+        sys.stdin, sys.stdout, sys.stderr = (
+            sys.__stdin__,
+            sys.__stdout__,
+            sys.__stderr__,
+        )
+        setup_logger()
+        for s in signals:
+            signal.signal(s, signal.SIG_DFL)
+        os.environ.clear()
+        os.environ.update(environ)
+
+        yield
+        code = 0
+    except SystemExit as e:
+        code = e.code if isinstance(e.code, int) else 1
+    except BaseException as e:
+        from traceback import print_exc
+
+        print_exc()
+        error = e
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        try:
+            if on_exit:
+                on_exit(error)
+        finally:
+            os._exit(code)
+
+
 def render_file(template_path: Path, output: Path, context: Dict[str, Any]) -> None:
     from jinja2 import StrictUndefined, Template
 
@@ -93,6 +167,78 @@ def render_py_file(template_path: Path, output: Path, context: Dict[str, Any]) -
         pass
 
 
+def write_if_changed(path: Path, content: str) -> bool:
+    """
+    Atomically write content to a file unless it already has the same content.
+
+    :return: True if file was written
+    """
+    if path.exists() and path.read_text() == content:
+        return False
+
+    write_atomic(path, content)
+    return True
+
+
+def write_atomic(path: Path, content: str) -> None:
+    """
+    Write content to a file so readers never see it partially written.
+    """
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_name(f".{path.name}.{os.getpid()}")
+    tmp_path.write_text(content)
+    os.replace(str(tmp_path), str(path))
+
+
+def dedupe_paths(paths: Iterable[str]) -> List[str]:
+    """
+    Remove duplicated paths keeping the first occurrence, so lookup order doesn't change.
+    """
+    ret = []
+    seen = set()
+    for p in paths:
+        key = os.path.normpath(p) if p else p
+        if key not in seen:
+            seen.add(key)
+            ret.append(p)
+    return ret
+
+
+class LineBuffer:
+    """
+    Split text arriving in chunks into lines, the incomplete last line is kept until the rest arrives.
+
+    Bytes are decoded incrementally, so characters split between chunks are decoded whole.
+    """
+
+    def __init__(self, errors: str = "strict") -> None:
+        """
+        :param errors: how to handle invalid utf-8 in bytes, same as in bytes.decode
+        """
+        self.pending = ""
+        self._decoder = codecs.getincrementaldecoder("utf-8")(errors)
+
+    def feed(self, data: Union[str, bytes]) -> List[str]:
+        """
+        :return: complete lines, with line ends
+        """
+        if isinstance(data, bytes):
+            data = self._decoder.decode(data)
+
+        lines, newline, self.pending = (self.pending + data).rpartition("\n")
+        if not newline:
+            return []
+        return [line + "\n" for line in lines.split("\n")]
+
+    def take_pending(self) -> str:
+        """
+        Return the incomplete line and forget it, decoding any bytes left.
+        """
+        ret = self.pending + self._decoder.decode(b"", final=True)
+        self.pending = ""
+        return ret
+
+
 def import_from_file(path: Path) -> Any:
     if not path.is_absolute():
         frame = inspect.stack()[1]
@@ -0,0 +1,242 @@
+import sys
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from dataclasses import dataclass, field
+from threading import Lock, local
+from typing import Any, Callable, Dict, List, Optional, TextIO
+
+from envo.misc import EnvoError, LineBuffer
+
+__all__ = ["TaskResult", "OutputWriter", "ThreadOutput", "PrefixedOutput", "run_dag"]
+
+
+@dataclass
+class TaskResult:
+    """
+    Result of a task executed by run_dag.
+
+    status is one of "done", "failed" or "cancelled".
+    """
+
+    name: str
+    status: str = "cancelled"
+    value: Any = None
+    error: Optional[BaseException] = None
+    output: List[str] = field(default_factory=list)
+
+    @property
+    def exit_code(self) -> int:
+        if isinstance(self.error, SystemExit):
+            return self.error.code if isinstance(self.error.code, int) else 1
+        return 1 if self.error else 0
+
+
+class OutputWriter:
+    """
+    Writer of ThreadOutput, gets text written by its thread and returns text to pass on.
+
+    Text written by the thread goes through the writer while in its with block.
+    """
+
+    def __enter__(self) -> "OutputWriter":
+        ThreadOutput.add(self)
+        return self
+
+    def __exit__(self, *args: Any) -> None:
+        ThreadOutput.remove(self)
+
+    def write(self, text: str) -> str:
+        return text
+
+    def finish(self) -> str:
+        """
+        Called when the writer is removed.
+
+        :return: text held back so far
+        """
+        return ""
+
+
+class ThreadOutput:
+    """
+    Stdout replacement passing text written by each thread through writers added by that thread.
+
+    A single replacement is installed while any thread has writers, so threads running
+    concurrently (like tasks of run_dag) can add and remove them in any order.
+    Writers of a thread are stacked, text goes from the last added one down to the original stdout.
+    Writes of threads without writers are passed through.
+    """
+
+    _lock = Lock()
+    _installed: Optional["ThreadOutput"] = None
+    _users = 0
+
+    def __init__(self, device: TextIO) -> None:
+        self.device = device
+        self._local = local()
+        # so lines of parallel threads don't get mixed up
+        self._write_lock = Lock()
+
+    @classmethod
+    def add(cls, writer: OutputWriter) -> None:
+        with cls._lock:
+            if not cls._installed:
+                cls._installed = cls(sys.stdout)
+                sys.stdout = cls._installed  # type: ignore
+            cls._users += 1
+            cls._installed._writers().append(writer)
+
+    @classmethod
+    def remove(cls, writer: OutputWriter) -> None:
+        with cls._lock:
+            out = cls._installed
+        assert out
+
+        writers = out._writers()
+        writers.remove(writer)
+        out._write(writer.finish(), writers)
+
+        with cls._lock:
+            cls._users -= 1
+            if not cls._users:
+                if sys.stdout is out:
+                    sys.stdout = out.device
+                cls._installed = None
+
+    def _writers(self) -> List[OutputWriter]:
+        if not hasattr(self._local, "writers"):
+            self._local.writers = []
+        ret: List[OutputWriter] = self._local.writers
+        return ret
+
+    def _write(self, text: str, writers: List[OutputWriter]) -> None:
+        for w in reversed(writers):
+            if not text:
+                return
+            text = w.write(text)
+
+        if text:
+            with self._write_lock:
+                self.device.write(text)
+                if "\n" in text:
+                    self.device.flush()
+
+    def write(self, text: Any) -> None:
+        if isinstance(text, bytes):
+            text = text.decode("utf-8")
+        self._write(text, self._writers())
+
+    def flush(self) -> None:
+        self.device.flush()
+
+    def isatty(self) -> bool:
+        return False
+
+
+class PrefixedOutput(OutputWriter):
+    """
+    Prefix lines written by a task thread with the task name and collect them in TaskResult.output.
+
+    Lines are written whole so outputs of parallel tasks don't get mixed up.
+    """
+
+    def __init__(self, task: TaskResult) -> None:
+        self.task = task
+        self._lines = LineBuffer()
+
+    def write(self, text: str) -> str:
+        return "".join(self._prefix(line) for line in self._lines.feed(text))
+
+    def finish(self) -> str:
+        rest = self._lines.take_pending()
+        return self._prefix(rest + "\n") if rest else ""
+
+    def _prefix(self, line: str) -> str:
+        self.task.output.append(line.rstrip("\r\n"))
+        return f"[{self.task.name}] {line}"
+
+
+def _check_deps(tasks: Dict[str, Callable], deps: Dict[str, List[str]]) -> None:
+    for name, task_deps in deps.items():
+        unknown = [d for d in task_deps if d not in tasks]
+        if unknown:
+            raise EnvoError(f'Unknown dependencies {unknown} of "{name}"')
+
+    visited: Dict[str, bool] = {}
+
+    def visit(name: str, path: List[str]) -> None:
+        if visited.get(name):
+            return
+        if name in path:
+            raise EnvoError(f"Dependency cycle {' -> '.join(path + [name])}")
+        for d in deps.get(name, []):
+            visit(d, path + [name])
+        visited[name] = True
+
+    for name in tasks.keys():
+        visit(name, [])
+
+
+def run_dag(
+    tasks: Dict[str, Callable[[], Any]],
+    deps: Optional[Dict[str, List[str]]] = None,
+    max_workers: Optional[int] = None,
+) -> Dict[str, TaskResult]:
+    """
+    Run tasks concurrently in a thread pool respecting dependencies between them.
+
+    Task is started when all of its dependencies are done.
+    Dependents of a failed task (including SystemExit from run) are cancelled,
+    independent tasks keep running.
+    Output of each task is prefixed with its name and collected in TaskResult.output.
+
+    :param tasks: task name to callable mapping
+    :param deps: task name to names of tasks it depends on
+    :param max_workers: max number of tasks running at once, defaults to number of tasks
+    :return: task name to result mapping
+    """
+    dependencies: Dict[str, List[str]] = deps or {}
+    _check_deps(tasks, dependencies)
+
+    results = {name: TaskResult(name=name) for name in tasks.keys()}
+    pending = list(tasks.keys())
+    running: Dict[Future, str] = {}
+
+    def execute(name: str) -> None:
+        result = results[name]
+        try:
+            with PrefixedOutput(result):
+                result.value = tasks[name]()
+            result.status = "done"
+        except (Exception, SystemExit) as e:
+            result.error = e
+            result.status = (
+                "failed" if not isinstance(e, SystemExit) or e.code else "done"
+            )
+
+    def cancel_dependents(name: str) -> None:
+        for p in pending[:]:
+            if name in dependencies.get(p, []) and p in pending:
+                pending.remove(p)
+                cancel_dependents(p)
+
+    with ThreadPoolExecutor(max_workers=max_workers or max(len(tasks), 1)) as executor:
+        while pending or running:
+            ready = [
+                p
+                for p in pending
+                if all(results[d].status == "done" for d in dependencies.get(p, []))
+            ]
+            for name in ready:
+                pending.remove(name)
+                running[executor.submit(execute, name)] = name
+
+            if not running:
+                break
+
+            done, _ = wait(running.keys(), return_when=FIRST_COMPLETED)
+            for f in done:
+                name = running.pop(f)
+                if results[name].status == "failed":
+                    cancel_dependents(name)
+
+    return results
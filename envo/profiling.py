@@ -0,0 +1,172 @@
+import cProfile
+import os
+import pstats
+import sys
+import threading
+from collections import Counter, defaultdict
+from pathlib import Path
+from types import FrameType
+from typing import TYPE_CHECKING, Any, Dict, List, Optional, Tuple
+
+from loguru import logger
+
+from envo.misc import EnvoError
+
+if TYPE_CHECKING:
+    from envo.env import Command
+
+__all__ = ["profile", "Sampler", "modes"]
+
+modes = ["cprofile", "sample"]
+
+# (file, first line, function name), same as pstats uses
+Function = Tuple[str, int, str]
+
+
+class Sampler:
+    """
+    Sample stack of the thread that enabled it from a background thread.
+
+    Overhead doesn't depend on the number of function calls so it's suitable for long commands.
+    """
+
+    def __init__(self, interval_s: float = 0.005) -> None:
+        self.interval_s = interval_s
+        # stacks (outermost call first) and number of times they were sampled
+        self.samples: Counter = Counter()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._thread_id = 0
+        # frames above the one that enabled sampling are not included in stacks
+        self._skip_frames = 0
+
+    def enable(self) -> None:
+        self._thread_id = threading.get_ident()
+        self._skip_frames = 0
+        frame: Optional[FrameType] = sys._getframe(1)
+        while frame:
+            self._skip_frames += 1
+            frame = frame.f_back
+        self._stop.clear()
+        self._thread = threading.Thread(
+            target=self._sample, name="envo-sampler", daemon=True
+        )
+        self._thread.start()
+
+    def disable(self) -> None:
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+
+    def _sample(self) -> None:
+        while not self._stop.wait(self.interval_s):
+            frame: Optional[FrameType] = sys._current_frames().get(self._thread_id)
+            stack: List[Function] = []
+            while frame:
+                code = frame.f_code
+                stack.append((code.co_filename, code.co_firstlineno, code.co_name))
+                frame = frame.f_back
+            stack = stack[: len(stack) - self._skip_frames]
+            if stack:
+                self.samples[tuple(reversed(stack))] += 1
+
+    def dump_folded(self, path: Path) -> None:
+        """
+        Save stacks in folded format (flamegraph.pl, speedscope).
+        """
+        lines = [
+            ";".join(f"{Path(f).name}:{name}" for f, _, name in stack) + f" {count}"
+            for stack, count in self.samples.items()
+        ]
+        path.write_text("\n".join(lines) + "\n")
+
+    def print_stats(self, top: int) -> None:
+        total = sum(self.samples.values())
+        own: Counter = Counter()
+        inclusive: Counter = Counter()
+        for stack, count in self.samples.items():
+            own[stack[-1]] += count
+            for f in set(stack):
+                inclusive[f] += count
+
+        print(f"{total} samples every {self.interval_s * 1000:g} ms")
+        print(f"{'own %':>7}{'total %':>9}  function")
+        for f, count in inclusive.most_common(top):
+            print(
+                f"{own[f] / total:>7.1%}{count / total:>9.1%}  {f[2]} ({f[0]}:{f[1]})"
+            )
+
+
+def _write_callgrind(stats: pstats.Stats, path: Path) -> None:
+    """
+    Save stats in callgrind format (kcachegrind, qcachegrind), costs are in microseconds.
+    """
+    raw_stats: Dict[Function, Any] = stats.stats  # type: ignore
+    callees: Dict[Function, List[Tuple[Function, int, float]]] = defaultdict(list)
+    for func, (cc, nc, tt, ct, callers) in raw_stats.items():
+        for caller, (c_nc, c_cc, c_tt, c_ct) in callers.items():
+            callees[caller].append((func, c_nc, c_ct))
+
+    lines = ["events: Microseconds"]
+    for func, (cc, nc, tt, ct, callers) in raw_stats.items():
+        file, line, name = func
+        lines.extend([f"fl={file}", f"fn={name}", f"{line} {int(tt * 1e6)}"])
+        for (c_file, c_line, c_name), c_nc, c_ct in callees[func]:
+            lines.extend(
+                [
+                    f"cfl={c_file}",
+                    f"cfn={c_name}",
+                    f"calls={c_nc} {c_line}",
+                    f"{line} {int(c_ct * 1e6)}",
+                ]
+            )
+
+    path.write_text("\n".join(lines) + "\n")
+
+
+def profile(
+    cmd: "Command", *args: Any, mode: str = "cprofile", top: int = 20, **kwargs: Any
+) -> Any:
+    """
+    Run command in env root under a profiler and print functions that took the most time.
+
+    Results are saved in .envo/profiles: pstats and callgrind files for cprofile mode,
+    folded stacks for sample mode.
+
+    :param mode: "cprofile" (deterministic) or "sample" (low overhead, for long commands)
+    :param top: number of functions to print
+    :return: command return value
+    """
+    if mode not in modes:
+        raise EnvoError(f'Unknown profile mode "{mode}", should be one of {modes}')
+
+    assert cmd.env is not None
+    profiler: Any = Sampler() if mode == "sample" else cProfile.Profile()
+
+    cwd = Path(".").absolute()
+    os.chdir(str(cmd.env.root))
+    try:
+        profiler.enable()
+        try:
+            return cmd._call(*args, **kwargs)
+        finally:
+            profiler.disable()
+    finally:
+        os.chdir(str(cwd))
+
+        out_dir = cmd.env.root / ".envo" / "profiles"
+        out_dir.mkdir(parents=True, exist_ok=True)
+        name = f"{cmd.env.meta.stage}.{cmd.name}"
+
+        if mode == "sample":
+            files = [out_dir / f"{name}.folded"]
+            profiler.dump_folded(files[0])
+            profiler.print_stats(top)
+        else:
+            files = [out_dir / f"{name}.pstats", out_dir / f"callgrind.out.{name}"]
+            profiler.dump_stats(str(files[0]))
+            stats = pstats.Stats(profiler, stream=sys.stdout)
+            _write_callgrind(stats, files[1])
+            stats.sort_stats("cumulative").print_stats(top)
+
+        logger.info(f"Saved profile of {cmd.name} to {[str(f) for f in files]}")
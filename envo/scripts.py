@@ -1,20 +1,36 @@
 #!/usr/bin/env python3
 import argparse
+import importlib
+import inspect
 import os
 import re
 import sys
+import time
 from dataclasses import dataclass
 from pathlib import Path
-from threading import Thread
-from typing import Dict, List, Literal, Optional
+from functools import partial
+from queue import Queue
+from threading import Lock, Thread
+from types import ModuleType
+from typing import TYPE_CHECKING, Any, Dict, List, Literal, Optional, Tuple
 
 from ilock import ILock
-from inotify.adapters import Inotify  # type: ignore
 from jinja2 import Environment
 from loguru import logger
 
-from envo import Env, misc, shell
-from envo.misc import import_from_file, EnvoError
+from envo import Env, misc
+from envo.env import Command, MagicFunction, SubHook
+from envo.hooks import HookGuard
+from envo.jobs import Job, Jobs, bg, jobs
+from envo.metrics import Metrics, metrics
+from envo.profiling import profile
+from envo.activation import compile_activation
+from envo.misc import dedupe_paths, import_from_file, EnvoError
+from envo.trace import tracer
+
+if TYPE_CHECKING:
+    from inotify.adapters import Inotify  # type: ignore
+    from envo.shell import Shell, ShellState
 
 __all__ = ["stage_emoji_mapping"]
 
@@ -42,8 +58,8 @@ class Envo:
     selected_addons: List[str]
     addons: List[str]
     files_watchdog_thread: Thread
-    shell: shell.Shell
-    inotify: Inotify
+    shell: "Shell"
+    inotify: "Inotify"
     env_dirs: List[Path]
     quit: bool
     env: Env
@@ -57,75 +73,150 @@ class Envo:
         if unknown_addons:
             raise EnvoError(f"Unknown addons {unknown_addons}")
 
-        self.inotify = Inotify()
-
         self.env_dirs = self._get_env_dirs()
         self.quit: bool = False
 
         self.environ_before = os.environ.copy()  # type: ignore
+        # PATH of the last activated env, commands cache is refreshed when it changes
+        self._last_path: Optional[str] = None
 
         self._set_context_thread: Optional[Thread] = None
+        self._loading_thread: Optional[Thread] = None
+        self._restart_lock = Lock()
+        self.hook_guard = HookGuard()
 
     def spawn_shell(self, type: Literal["fancy", "simple", "headless"]) -> None:
         """
         :param type: shell type
         """
-        self.shell = shell.shells[type].create()
+        # xonsh is imported only when shell is needed since it takes a while
+        from envo import shell
+
+        with tracer.span("shell_create", type=type):
+            self.shell = shell.shells[type].create()
+        jobs.on_change = self._on_job_change
+        jobs.get_environ = self.shell.environ.detype
         self._start_files_watchdog()
 
-        self.restart()
+        if type == "headless":
+            self.restart()
+        else:
+            self._start_loading()
         self.shell.start()
 
+        if self._loading_thread and self._loading_thread.is_alive():
+            self._loading_thread.join()
+
         self._on_unload()
         self._stop_files_watchdog()
+        jobs.kill()
 
         self._on_destroy()
+        self._save_metrics()
+
+    def _start_loading(self) -> None:
+        """
+        Load env in background so the prompt shows up right away.
+
+        Commands typed before env is loaded wait for it.
+        """
+        self.shell.set_prompt_prefix(f"⏳({self.se.stage})")
+        self._loading_thread = Thread(target=self.restart, name="envo-loading")
+        self._loading_thread.start()
 
     def restart(self) -> None:
+        with self._restart_lock, tracer.span("restart"):
+            self._restart()
+
+    def _restart(self) -> None:
+        """
+        Reload env and publish new shell state.
+
+        Running commands are not waited for, they finish with the state they started with.
+        Paths are only added to sys.path while the env is created, so imports of running commands
+        keep working, the deduplicated sys.path is applied with the rest of the state.
+        """
+        from envo.shell import ShellState
+
         try:
             os.environ = self.environ_before.copy()  # type: ignore
 
             if not hasattr(self, "env"):
-                self.env = self.create_env()
+                with tracer.span("create_env"):
+                    self.env = self.create_env()
                 self._on_create()
             else:
                 self._on_unload()
-                self.env = self.create_env()
+                with tracer.span("create_env"):
+                    self.env = self.create_env()
 
-            self.env.validate()
-            self.env.activate()
+            with tracer.span("activate"):
+                self.env.validate()
+                self.env.activate()
             self._on_load()
-            self.shell.reset()
-            self.shell.set_variable("env", self.env)
-            self.shell.set_variable("environ", self.shell.environ)
-
-            self._set_context_thread = Thread(target=self._set_context)
-            self._set_context_thread.start()
+            path_changed = self._path_changed()
 
+            env = self.env
             glob_cmds = [
-                c for c in self.env.get_magic_functions()["command"] if c.kwargs["glob"]
+                c for c in env.get_magic_functions()["command"] if c.kwargs["glob"]
             ]
-            for c in glob_cmds:
-                self.shell.set_variable(c.name, c)
+            state = ShellState(
+                generation=self.shell.state.generation + 1,
+                env_vars=self.env.get_env_vars(),
+                sys_path=dedupe_paths(sys.path),
+                context={
+                    "env": env,
+                    "environ": self.shell.environ,
+                    "hooks": self.hook_guard,
+                    "profile": profile,
+                    "bg": bg,
+                    **{c.name: c for c in glob_cmds},
+                },
+                pre_cmd=partial(self._on_precmd, env),
+                on_stdout=partial(self._on_stdout, env),
+                on_stderr=partial(self._on_stderr, env),
+                post_cmd=partial(self._on_postcmd, env),
+                needs_output=partial(self._needs_output, env),
+                tee_output=partial(self._tee_output, env),
+            )
+            self.shell.set_state(state)
 
-            self.shell.pre_cmd = self._on_precmd
-            self.shell.on_stdout = self._on_stdout
-            self.shell.on_stderr = self._on_stderr
-            self.shell.post_cmd = self._on_postcmd
+            self._set_context_thread = Thread(
+                target=self._set_context,
+                args=(env, state.generation, path_changed),
+                name="envo-context",
+            )
+            self._set_context_thread.start()
 
-            self.shell.environ.update(self.env.get_env_vars())
             self.shell.set_prompt_prefix(
                 self._get_prompt_prefix(loading=self._set_context_thread.is_alive())
             )
 
         except EnvoError as exc:
             logger.error(exc)
+            self.shell.set_state(self._failed_state())
             self.shell.set_prompt_prefix("❌")
         except Exception:
             from traceback import print_exc
 
             print_exc()
+            self.shell.set_state(self._failed_state())
             self.shell.set_prompt_prefix("❌")
+        finally:
+            self.shell.ready.set()
+
+    def _failed_state(self) -> "ShellState":
+        """
+        State without env, variables of the last loaded env are kept.
+        """
+        from envo.shell import ShellState
+
+        last = self.shell.state
+        return ShellState(
+            generation=last.generation + 1,
+            env_vars=last.env_vars,
+            sys_path=last.sys_path,
+        )
 
     def _get_prompt_prefix(self, loading: bool = False) -> str:
         env_prefix = f"{self.env.meta.emoji}({self.env.get_full_name()})"
@@ -133,13 +224,42 @@ class Envo:
         if loading:
             env_prefix = "⏳" + env_prefix
 
+        running_jobs = jobs.running
+        if running_jobs:
+            env_prefix = f"⚙{running_jobs}" + env_prefix
+
         return env_prefix
 
-    def _set_context(self) -> None:
-        for c in self.env.get_magic_functions()["context"]:
-            context = c()
-            self.shell.update_context(context)
-        self.shell.set_prompt_prefix(self._get_prompt_prefix(loading=False))
+    def _on_job_change(self, job: Job) -> None:
+        loading = bool(self._set_context_thread and self._set_context_thread.is_alive())
+        self.shell.set_prompt_prefix(self._get_prompt_prefix(loading=loading))
+        if job.done:
+            logger.info(f"\n{job!r}")
+            print("\r" + self.shell.prompt, end="")
+
+    def _path_changed(self) -> bool:
+        """
+        :return: True if PATH changed since the last activation
+        """
+        path = os.environ.get("PATH")
+        path_changed = path != self._last_path
+        self._last_path = path
+        return path_changed
+
+    def _set_context(
+        self, env: Env, generation: int, path_changed: bool = False
+    ) -> None:
+        with tracer.span("set_context", generation=generation):
+            for c in env.get_magic_functions()["context"]:
+                context = c()
+                self.shell.update_context(context, generation=generation)
+
+            # so the first command after reload doesn't wait for PATH to be scanned
+            if path_changed:
+                self.shell.refresh_commands_cache()
+
+        if self.shell.state.generation == generation:
+            self.shell.set_prompt_prefix(self._get_prompt_prefix(loading=False))
 
     def _on_create(self) -> None:
         for h in self.env.get_magic_functions()["oncreate"]:
@@ -157,55 +277,88 @@ class Envo:
         for h in self.env.get_magic_functions()["onunload"]:
             h()
 
-    def _on_precmd(self, command: str) -> str:
-        for h in self.env.get_magic_functions()["precmd"]:
+    def _call_hook(self, env: Env, hook: MagicFunction, **kwargs: Any) -> Any:
+        return self.hook_guard.call(hook, env.meta.hook_budget_ms, **kwargs)
+
+    def _on_precmd(self, env: Env, command: str) -> str:
+        for h in env.get_magic_functions()["precmd"]:
             if re.match(h.kwargs["cmd_regex"], command):
-                ret = h(command=command)  # type: ignore
+                ret = self._call_hook(env, h, command=command)
                 if ret:
                     command = ret
         return command
 
-    def _on_stdout(self, command: str, out: str) -> str:
-        for h in self.env.get_magic_functions()["onstdout"]:
-            if re.match(h.kwargs["cmd_regex"], command):
-                ret = h(command=command, out=out)  # type: ignore
-                if ret:
-                    out = ret
-        return out
+    def _needs_output(self, env: Env, command: str) -> Tuple[bool, bool]:
+        def matches(type: str) -> bool:
+            return any(
+                re.match(h.kwargs["cmd_regex"], command)
+                for h in env.get_magic_functions()[type]
+            )
+
+        postcmd = matches("postcmd")
+        return postcmd or matches("onstdout"), postcmd or matches("onstderr")
+
+    def _tee_output(self, env: Env, command: str) -> bool:
+        hooks = (
+            env.get_magic_functions()["onstdout"]
+            + env.get_magic_functions()["onstderr"]
+        )
+        return any(
+            h.kwargs.get("tee") and re.match(h.kwargs["cmd_regex"], command)
+            for h in hooks
+        )
 
-    def _on_stderr(self, command: str, out: str) -> str:
-        for h in self.env.get_magic_functions()["onstderr"]:
+    def _on_stdout(self, env: Env, command: str, out: str) -> str:
+        return self._on_output(env, "onstdout", command, out)
+
+    def _on_stderr(self, env: Env, command: str, out: str) -> str:
+        return self._on_output(env, "onstderr", command, out)
+
+    def _on_output(self, env: Env, type: str, command: str, out: str) -> str:
+        out = env.get_substitutions(type)(command, out)
+
+        for h in env.get_magic_functions()[type]:
+            if isinstance(h, SubHook):
+                continue
             if re.match(h.kwargs["cmd_regex"], command):
-                ret = h(command=command, out=out)  # type: ignore
+                ret = self._call_hook(env, h, command=command, out=out)
                 if ret:
                     out = ret
         return out
 
-    def _on_postcmd(self, command: str, stdout: List[str], stderr: List[str]) -> None:
-        for h in self.env.get_magic_functions()["postcmd"]:
+    def _on_postcmd(
+        self, env: Env, command: str, stdout: List[str], stderr: List[str]
+    ) -> None:
+        for h in env.get_magic_functions()["postcmd"]:
             if re.match(h.kwargs["cmd_regex"], command):
-                h(command=command, stdout=stdout, stderr=stderr)  # type: ignore
+                self._call_hook(env, h, command=command, stdout=stdout, stderr=stderr)
 
     def _files_watchdog(self) -> None:
         for event in self.inotify.event_gen(yield_nones=False):
             if self.quit:
                 return
 
-            (_, type_names, path, filename) = event
+            _, type_names, path, filename = event
             if "IN_CLOSE_WRITE" in type_names:
                 logger.info(f'\nDetected changes in "{str(path)}".')
                 logger.info("Reloading...")
-                self.restart()
+                with tracer.span("file_change", path=path):
+                    self.restart()
                 print("\r" + self.shell.prompt, end="")
 
     def _start_files_watchdog(self) -> None:
+        from inotify.adapters import Inotify  # type: ignore
+
+        self.inotify = Inotify()
         for d in self.env_dirs:
             comm_env_file = d / "env_comm.py"
             env_file = d / f"env_{self.se.stage}.py"
             self.inotify.add_watch(str(comm_env_file))
             self.inotify.add_watch(str(env_file))
 
-        self.files_watchdog_thread = Thread(target=self._files_watchdog)
+        self.files_watchdog_thread = Thread(
+            target=self._files_watchdog, name="envo-watcher"
+        )
         self.files_watchdog_thread.start()
 
     def _stop_files_watchdog(self) -> None:
@@ -284,7 +437,7 @@ class Envo:
                     sys.modules.pop(m)
 
             try:
-                module = import_from_file(env_file)
+                module = self._import_env_module(env_file)
                 env: Env
                 env = module.Env()
                 return env
@@ -293,6 +446,9 @@ class Envo:
             finally:
                 self._delete_init_files()
 
+    def _import_env_module(self, env_file: Path) -> Any:
+        return import_from_file(env_file)
+
     def _create_from_templ(
         self, templ_file: Path, output_file: Path, is_comm: bool = False
     ) -> None:
@@ -349,6 +505,139 @@ class Envo:
         self._create_from_templ(Path("env.py.templ"), env_file)
         logger.info(f"Created {self.se.stage} environment 🍰!")
 
+    def compile(self) -> None:
+        """
+        Compile activation scripts so env can be activated without starting python.
+        """
+        env = self.create_env()
+        env.validate()
+
+        sources = []
+        for d in self.env_dirs:
+            sources.extend([d / "env_comm.py", d / f"env_{self.se.stage}.py"])
+
+        files = compile_activation(
+            env.get_env_vars(),
+            stage=self.se.stage,
+            root=self.env_dirs[0],
+            sources=[s for s in sources if s.exists()],
+        )
+        loaders = [str(f) for f in files if f.name.startswith("activate_")]
+        logger.info(f"Compiled activation scripts, source one of {loaders} 🚀")
+
+    def exec(self, argv: List[str]) -> None:
+        """
+        Activate env and replace current process with a program.
+
+        Shell is not started so onunload and ondestroy hooks are not called.
+        """
+        if not argv:
+            raise EnvoError("No program to execute.")
+
+        self.env = self.create_env()
+        self.env.activate()
+        self._on_load()
+
+        # exec skips atexit handlers
+        self._save_metrics()
+        tracer.save()
+        sys.stdout.flush()
+        sys.stderr.flush()
+        try:
+            os.execvpe(argv[0], argv, os.environ)
+        except FileNotFoundError:
+            logger.error(f'Program "{argv[0]}" not found.')
+            sys.exit(127)
+
+    def run_command(self, argv: List[str]) -> None:
+        """
+        Run env command with arguments parsed from the command line and exit.
+
+        Shell is not started, env is activated and onload hooks are called before the command.
+        Command is profiled if arguments start with --profile or --profile=sample.
+        """
+        profile_mode = None
+        if argv and argv[0].startswith("--profile"):
+            profile_mode = argv[0].partition("=")[2] or "cprofile"
+            argv = argv[1:]
+
+        if not argv:
+            raise EnvoError("No command to run.")
+
+        try:
+            self.env = self.create_env()
+            self.env.activate()
+            self._on_load()
+
+            name = argv[0]
+            cmd = getattr(self.env, name, None)
+            if not isinstance(cmd, Command):
+                commands = [c.name for c in self.env.get_magic_functions()["command"]]
+                raise EnvoError(
+                    f'Unknown command "{name}", available commands: {commands}'
+                )
+        except EnvoError as e:
+            logger.error(e)
+            sys.exit(1)
+
+        args, kwargs = _parse_command_args(
+            cmd, argv[1:], prog=f"envo {self.se.stage} run {name}"
+        )
+        try:
+            if profile_mode:
+                ret = profile(cmd, *args, mode=profile_mode, **kwargs)
+            else:
+                ret = cmd._call_foreground(*args, **kwargs)
+        finally:
+            self._save_metrics()
+        if ret is not None:
+            print(ret)
+
+        sys.exit(0)
+
+    def _save_metrics(self) -> None:
+        """
+        Merge metrics of this process into .envo/metrics.json.
+
+        Merged metrics are also exported to ENVO_METRICS_FILE if it's set (.prom for Prometheus text format).
+        """
+        if not metrics:
+            return
+
+        try:
+            merged = metrics.save(self.env_dirs[0] / ".envo" / "metrics.json")
+            export_file = os.environ.get("ENVO_METRICS_FILE")
+            if export_file:
+                merged.export(Path(export_file))
+        except OSError as e:
+            logger.warning(f"Couldn't save metrics ({e})")
+        metrics.clear()
+
+    def show_stats(self, argv: List[str]) -> None:
+        """
+        Print commands and hooks latencies collected in this project.
+        """
+        parser = argparse.ArgumentParser(prog="envo stats")
+        output = parser.add_mutually_exclusive_group()
+        output.add_argument("--json", action="store_true")
+        output.add_argument("--prometheus", action="store_true")
+        output.add_argument("--reset", action="store_true")
+        args = parser.parse_args(argv)
+
+        path = self.env_dirs[0] / ".envo" / "metrics.json"
+        if args.reset:
+            if path.exists():
+                path.unlink()
+            return
+
+        data = Metrics.load(path)
+        if args.json:
+            print(data.to_json())
+        elif args.prometheus:
+            print(data.to_prometheus(), end="")
+        else:
+            print(repr(data))
+
     def handle_command(self, args: argparse.Namespace) -> None:
         if args.version:
             from envo.__version__ import __version__
@@ -370,13 +659,31 @@ class Envo:
             self.create_env().dump_dot_env()
             return
 
+        if args.compile:
+            self.compile()
+            return
+
+        if args.action == "exec":
+            self.exec(args.action_args)
+            return
+
+        if args.action == "run":
+            self.run_command(args.action_args)
+            return
+
+        if args.action == "stats":
+            self.show_stats(args.action_args)
+            return
+
         if args.command:
             self.spawn_shell("headless")
             try:
                 self.shell.default(args.command)
             except SystemExit as e:
+                self._save_metrics()
                 sys.exit(e.code)
             else:
+                self._save_metrics()
                 sys.exit(self.shell.history[-1].rtn)
 
         if args.dry_run:
@@ -391,22 +698,222 @@ class Envo:
             self.spawn_shell(args.shell)
 
 
-def _main() -> None:
-    sys.argv[0] = "/home/kwazar/Code/opensource/envo/.venv/bin/xonsh"
-    parser = argparse.ArgumentParser()
+class StageEnvo(Envo):
+    """
+    Envo running a command in one of the stages of `envo --stages a,b run <command>`.
+
+    env_comm is imported once before workers are forked and shared by all stages.
+    """
+
+    comm_module: Optional[ModuleType] = None
+
+    @classmethod
+    def preload_comm(cls, env_dir: Path) -> None:
+        sys.path.insert(0, str(env_dir))
+        sys.modules.pop("env_comm", None)
+        try:
+            cls.comm_module = importlib.import_module("env_comm")
+        except Exception:
+            # stages report the error
+            cls.comm_module = None
+        finally:
+            sys.path.remove(str(env_dir))
+            sys.modules.pop("env_comm", None)
+
+    def _import_env_module(self, env_file: Path) -> Any:
+        if self.comm_module:
+            sys.modules["env_comm"] = self.comm_module
+        return super()._import_env_module(env_file)
+
+
+def _run_stage(stage: str, args: argparse.Namespace) -> None:
+    try:
+        StageEnvo(Envo.Sets(stage=stage, addons=[], init=False)).handle_command(args)
+    except EnvoError as e:
+        logger.error(e)
+        sys.exit(1)
+
+
+def _run_stages(stages: List[str], args: argparse.Namespace) -> int:
+    """
+    Run command in each stage in its own worker process, all at once.
+
+    Output of each stage is printed when it finishes, followed by a summary.
+
+    :return: exit code of the first failing stage (in the order of stages), 0 if all succeeded
+    """
+    env_dirs = Envo(Envo.Sets(stage=stages[0], addons=[], init=False)).env_dirs
+    if env_dirs:
+        StageEnvo.preload_comm(env_dirs[0])
+
+    finished: "Queue[Job]" = Queue()
+    stage_jobs = Jobs(max_workers=len(stages))
+    stage_jobs.on_change = lambda job: finished.put(job) if job.done else None
+    results = {
+        stage: stage_jobs.start(stage, _run_stage, stage, args) for stage in stages
+    }
+
+    try:
+        for _ in stages:
+            job = finished.get()
+            print(f"=== {job.name} ({job.status} in {job.wall_time:.2f} s) ===")
+            for line in job.output:
+                print(line)
+    except KeyboardInterrupt:
+        stage_jobs.kill()
+        raise
+
+    print(f"{'stage':<20} {'status':<8} {'exit':>4} {'wall[s]':>8}")
+    for stage, job in results.items():
+        print(f"{stage:<20} {job.status:<8} {job.exit_code:>4} {job.wall_time:>8.3f}")
+
+    return next((job.exit_code for job in results.values() if job.exit_code), 0)
+
+
+actions = ["exec", "run", "stats"]
+
+
+def _parse_command_args(
+    cmd: Command, argv: List[str], prog: str
+) -> Tuple[List[Any], Dict[str, Any]]:
+    """
+    Parse command line arguments according to command's signature.
+
+    Arguments without defaults are positional, the rest are options (--some-arg).
+    Bool arguments are flags.
+
+    :return: args and kwargs to call the command with
+    """
+    parser = argparse.ArgumentParser(prog=prog, description=inspect.getdoc(cmd.func))
+
+    params = list(inspect.signature(cmd.func).parameters.values())[1:]
+    for p in params:
+        arg_type = p.annotation if p.annotation in [int, float, str] else str
+        option = "--" + p.name.replace("_", "-")
+
+        if p.kind == p.VAR_POSITIONAL:
+            parser.add_argument(p.name, nargs="*", type=arg_type)
+        elif p.kind == p.VAR_KEYWORD:
+            continue
+        elif p.default is p.empty and p.kind != p.KEYWORD_ONLY:
+            parser.add_argument(p.name, type=arg_type)
+        elif p.default is p.empty:
+            parser.add_argument(option, dest=p.name, type=arg_type, required=True)
+        elif p.annotation is bool or isinstance(p.default, bool):
+            if p.default:
+                parser.add_argument(
+                    "--no-" + p.name.replace("_", "-"),
+                    dest=p.name,
+                    action="store_false",
+                )
+            else:
+                parser.add_argument(option, dest=p.name, action="store_true")
+        else:
+            parser.add_argument(option, dest=p.name, type=arg_type, default=p.default)
+
+    if "inputs" in cmd.kwargs and "force" not in [p.name for p in params]:
+        parser.add_argument(
+            "--force", action="store_true", help="run even if inputs didn't change"
+        )
+
+    kwargs = vars(parser.parse_args(argv))
+    args: List[Any] = []
+    for p in params:
+        if p.kind == p.VAR_POSITIONAL:
+            args.extend(kwargs.pop(p.name))
+        elif p.default is p.empty and p.kind not in [p.VAR_KEYWORD, p.KEYWORD_ONLY]:
+            args.append(kwargs.pop(p.name))
+
+    return args, kwargs
+
+
+def _split_action(argv: List[str]) -> Tuple[List[str], Optional[str], List[str]]:
+    """
+    Split arguments into envo arguments, action and action arguments.
+
+    Action follows the stage or stages, eg. envo ci exec -- pytest -x, envo --stages ci,prod run check
+    """
+    i = 0
+    positional = 0
+    while i < len(argv) and positional < 2:
+        arg = argv[i]
+        if arg in actions:
+            action_args = argv[i:][1:]
+            if action_args[:1] == ["--"]:
+                action_args = action_args[1:]
+            return argv[:i], arg, action_args
+        if arg == "--stages":
+            i += 2
+            continue
+        if arg.startswith("--stages="):
+            i += 1
+            continue
+        if arg.startswith("-"):
+            break
+        positional += 1
+        i += 1
+
+    return argv, None, []
+
+
+def _parse_args(argv: List[str]) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(prog="envo")
     parser.add_argument(
         "stage", type=str, default="local", help="Stage to activate.", nargs="?"
     )
     parser.add_argument("--dry-run", default=False, action="store_true")
     parser.add_argument("--version", default=False, action="store_true")
     parser.add_argument("--save", default=False, action="store_true")
+    parser.add_argument("--compile", default=False, action="store_true")
     parser.add_argument("--shell", default="fancy")
     parser.add_argument("-c", "--command", default=None)
     parser.add_argument("-i", "--init", nargs="?", const=True, action="store")
+    parser.add_argument(
+        "--stages",
+        default=None,
+        help="Comma separated stages to run command in, in parallel (envo --stages local,ci run <command>).",
+    )
+    parser.add_argument(
+        "--daemon",
+        default=False,
+        action="store_true",
+        help="Serve envo requests of this project over a unix socket.",
+    )
+
+    envo_argv, action, action_args = _split_action(argv)
+    args = parser.parse_args(envo_argv)
+    args.action = action
+    args.action_args = action_args
+    return args
+
 
-    args = parser.parse_args(sys.argv[1:])
+def _main() -> None:
+    start = time.monotonic()
+    sys.argv[0] = "/home/kwazar/Code/opensource/envo/.venv/bin/xonsh"
+    argv = sys.argv[1:]
+    args = _parse_args(argv)
     sys.argv = sys.argv[:1]
 
+    if args.stages:
+        if args.action != "run":
+            logger.error("--stages can be used only with run.")
+            sys.exit(1)
+        sys.exit(_run_stages(args.stages.split(","), args))
+
+    spawns_shell = not any(
+        [args.version, args.init, args.save, args.compile, args.daemon]
+        + [args.command, args.dry_run, args.action]
+    )
+    # shells forked by the daemon get a new pty proxied to our terminal
+    attach_shell = spawns_shell and sys.stdin.isatty() and sys.stdout.isatty()
+    if attach_shell or args.command or args.dry_run or args.action:
+        from envo.daemon import find_socket, request
+
+        socket_path = find_socket()
+        code = request(socket_path, argv, pty=spawns_shell) if socket_path else None
+        if code is not None:
+            sys.exit(code)
+
     if isinstance(args.init, str):
         selected_addons = args.init.split()
     else:
@@ -415,9 +922,15 @@ def _main() -> None:
     envo = Envo(
         Envo.Sets(stage=args.stage, addons=selected_addons, init=bool(args.init))
     )
+    tracer.complete("startup", start, time.monotonic())
 
     try:
-        envo.handle_command(args)
+        if args.daemon:
+            from envo.daemon import Daemon, find_project_root
+
+            Daemon(find_project_root()).serve()
+        else:
+            envo.handle_command(args)
     except EnvoError as e:
         logger.error(e)
 
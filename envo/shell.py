@@ -1,15 +1,238 @@
 import builtins
+import importlib
 import sys
 import time
-from copy import copy
-from threading import Lock
-from typing import Any, Dict, Callable, Optional, List, TextIO
+from collections.abc import MutableMapping, MutableSequence, MutableSet
+from dataclasses import dataclass, field, replace
+from threading import Event, Lock, RLock, Timer
+from typing import (
+    Any,
+    BinaryIO,
+    Dict,
+    Callable,
+    Optional,
+    List,
+    Set,
+    TextIO,
+    Tuple,
+    Union,
+)
 
 from xonsh.base_shell import BaseShell
+from xonsh.environ import Env
 from xonsh.execer import Execer
 from xonsh.ptk_shell.shell import PromptToolkitShell
 from xonsh.readline_shell import ReadlineShell
 
+from envo.tee import tee_output
+from envo.trace import tracer
+
+
+@dataclass(frozen=True)
+class ShellState:
+    """
+    Env related shell state.
+
+    State is never modified, reloads publish a new one with a higher generation.
+    Commands use the state published when they started. Its variables and sys.path
+    are applied when a command starts (right away if no command is running),
+    so a reload never changes them under a running command.
+    """
+
+    generation: int = 0
+    context: Dict[str, Any] = field(default_factory=dict)
+    env_vars: Dict[str, str] = field(default_factory=dict)
+    # None leaves sys.path as it is
+    sys_path: Optional[List[str]] = None
+    pre_cmd: Optional[Callable] = None
+    on_stdout: Optional[Callable] = None
+    on_stderr: Optional[Callable] = None
+    post_cmd: Optional[Callable] = None
+    # tells if hooks need text of command's (stdout, stderr), output is passed through otherwise
+    needs_output: Optional[Callable[[str], Tuple[bool, bool]]] = None
+    # tells if hooks need output of command's subprocesses too, see envo.tee
+    tee_output: Optional[Callable[[str], bool]] = None
+
+
+class OutputStream:
+    """
+    Replacement of sys.stdout or sys.stderr used while shell commands run.
+
+    Without hooks output is passed through: xonsh writes subprocess output straight to the
+    binary buffer of the device (exposed as `buffer`) and nothing is decoded or copied.
+    With hooks there is no `buffer` so xonsh decodes the output, which is passed to the hook
+    and captured.
+    Writes containing a newline flush the device. Flushes are coalesced, the device is flushed
+    at most once per flush interval and the rest is flushed by a timer or at the end of the command.
+    """
+
+    flush_interval_s = 0.02
+
+    def __init__(self, name: str) -> None:
+        """
+        :param name: "stdout" or "stderr"
+        """
+        self.name = name
+        self.command = ""
+        self.on_write: Optional[Callable] = None
+        self.output: List[str] = []
+        self._flushed_at = 0.0
+        self._timer: Optional[Timer] = None
+        self._lock = Lock()
+
+    @property
+    def device(self) -> TextIO:
+        # resolved on every use, daemon children get new streams after fork
+        return getattr(sys, f"__{self.name}__")  # type: ignore
+
+    @property
+    def buffer(self) -> BinaryIO:
+        if self.on_write:
+            raise AttributeError("buffer")
+        return self.device.buffer
+
+    @property
+    def encoding(self) -> str:
+        return self.device.encoding
+
+    def fileno(self) -> int:
+        return self.device.fileno()
+
+    def isatty(self) -> bool:
+        return self.device.isatty()
+
+    def start(self, command: str, on_write: Optional[Callable]) -> None:
+        """
+        :param on_write: hook called with text written by the command, None to pass it through
+        """
+        # text written before the command is still in the text layer
+        self.device.flush()
+        self.command = command
+        self.on_write = on_write
+        self.output = []
+
+    def finish(self) -> None:
+        with self._lock:
+            if self._timer:
+                self._timer.cancel()
+                self._timer = None
+        self._flush()
+        self.on_write = None
+
+    def write(self, data: Union[str, bytes]) -> int:
+        if not self.on_write:
+            # write to the same layer as xonsh does so outputs can't get reordered
+            if isinstance(data, str):
+                data = data.encode(self.device.encoding, "replace")
+            ret = self.device.buffer.write(memoryview(data))
+        else:
+            text = (
+                data.decode(self.device.encoding, "replace")
+                if isinstance(data, bytes)
+                else data
+            )
+            text = self.on_write(command=self.command, out=text)
+            self.output.append(text)
+            self.device.buffer.write(text.encode(self.device.encoding, "replace"))
+            ret = len(data)
+
+        # complete lines shouldn't wait in the buffer until the command finishes
+        if (b"\n" in data) if isinstance(data, bytes) else ("\n" in data):
+            self.flush()
+        return ret
+
+    def flush(self) -> None:
+        with self._lock:
+            if self._timer:
+                return
+            delay = self._flushed_at + self.flush_interval_s - time.monotonic()
+            if delay > 0:
+                self._timer = Timer(delay, self._flush)
+                self._timer.daemon = True
+                self._timer.start()
+                return
+        self._flush()
+
+    def _flush(self) -> None:
+        with self._lock:
+            self._timer = None
+            self._flushed_at = time.monotonic()
+        self.device.buffer.flush()
+
+
+stdout = OutputStream("stdout")
+stderr = OutputStream("stderr")
+
+
+class Environ(Env):  # type: ignore
+    """
+    Xonsh env keeping detyped variables cached.
+
+    Xonsh detypes the whole env before launching every subprocess since reading any mutable
+    variable (like PATH) drops its cache. Here variables are detyped when they're set
+    and only mutable ones are detyped again on each call.
+    """
+
+    def __init__(self, *args: Any, **kwargs: Any) -> None:
+        self._cache: Optional[Dict[str, str]] = None
+        self._mutable: Set[str] = set()
+        # cache was returned to the caller so it's copied before being modified
+        self._cache_shared = False
+        # variables are set from the shell and from envo threads (prompt, jobs)
+        self._lock = RLock()
+        super().__init__(*args, **kwargs)
+
+    def detype(self) -> Dict[str, str]:
+        with self._lock:
+            if self._cache is None:
+                self._cache = {}
+                self._cache_shared = False
+                for key in list(self._d.keys()):
+                    self._detype_var(key)
+            else:
+                for key in list(self._mutable):
+                    self._detype_var(key)
+
+            self._cache_shared = True
+            return self._cache
+
+    def _detype_var(self, key: str) -> None:
+        assert self._cache is not None
+
+        value = None
+        if key in self._d:
+            detyper = self.get_detyper(key)
+            value = detyper(self._d[key]) if detyper else None
+
+        if isinstance(self._d.get(key), (MutableMapping, MutableSequence, MutableSet)):
+            self._mutable.add(key)
+        else:
+            self._mutable.discard(key)
+
+        if self._cache.get(key) == value:
+            return
+
+        if self._cache_shared:
+            self._cache = dict(self._cache)
+            self._cache_shared = False
+
+        if value is None:
+            self._cache.pop(key, None)
+        else:
+            self._cache[key] = value
+
+    def __setitem__(self, key: str, value: Any) -> None:
+        with self._lock:
+            super().__setitem__(key, value)
+            if self._cache is not None:
+                self._detype_var(key)
+
+    def __delitem__(self, key: str) -> None:
+        with self._lock:
+            super().__delitem__(key)
+            if self._cache is not None:
+                self._detype_var(key)
+
 
 class Shell(BaseShell):  # type: ignore
     """
@@ -19,56 +242,110 @@ class Shell(BaseShell):  # type: ignore
     def __init__(self, execer: Execer) -> None:
         super().__init__(execer=execer, ctx={})
 
-        self.environ = builtins.__xonsh__.env  # type: ignore
+        self.environ: Environ = builtins.__xonsh__.env  # type: ignore
         self.history = builtins.__xonsh__.history  # type: ignore
-        self.environ_before = copy(self.environ)
-        self.context: Dict[str, Any] = {}
-
-        self.pre_cmd: Optional[Callable] = None
-        self.on_stdout: Optional[Callable] = None
-        self.on_stderr: Optional[Callable] = None
-        self.post_cmd: Optional[Callable] = None
-
-        self.cmd_lock = Lock()
+        self.environ_before = dict(self.environ.detype())
+        # variables set by the current env
+        self._env_vars: Dict[str, str] = {}
+
+        self.state = ShellState()
+        # serializes state publishers (reloads, context thread), commands don't take it
+        self._state_lock = Lock()
+        # held while a command runs, variables and sys.path of a new state wait for it
+        self._command_lock = RLock()
+        self._applied_generation = -1
+        # set when env is loaded, user commands wait for it
+        self.ready = Event()
 
     def set_prompt_prefix(self, prefix: str) -> None:
         from xonsh.prompt.base import DEFAULT_PROMPT
 
         self.environ["PROMPT"] = prefix + str(DEFAULT_PROMPT)
 
+    def set_state(self, state: ShellState) -> None:
+        """
+        Publish new state, variables of the previous one are removed from the shell.
+
+        :param state: state with a higher generation than the current one
+        """
+        with self._state_lock:
+            for name in self.state.context.keys() - state.context.keys():
+                self.ctx.pop(name, None)
+            self.ctx.update(state.context)
+            self.state = state
+
+        if self._command_lock.acquire(blocking=False):
+            try:
+                self._apply_state(state)
+            finally:
+                self._command_lock.release()
+
+    def _apply_state(self, state: ShellState) -> None:
+        """
+        Set variables and sys.path of the state, if they aren't set already.
+        """
+        if state.generation <= self._applied_generation:
+            return
+
+        self.set_env_vars(state.env_vars)
+        if state.sys_path is not None and sys.path != state.sys_path:
+            sys.path[:] = state.sys_path
+            importlib.invalidate_caches()
+        self._applied_generation = state.generation
+
     def set_variable(self, name: str, value: Any) -> None:
         """
         Send a variable to the shell.
 
         :param name: variable name
         :param value: variable value
-        :return:
         """
-        self.context[name] = value
+        self.update_context({name: value})
 
-        built_in_name = f"__envo_{name}__"
-        setattr(builtins, built_in_name, value)
-        self.default(f"{name} = {built_in_name}")
+    def update_context(
+        self, context: Dict[str, Any], generation: Optional[int] = None
+    ) -> None:
+        """
+        Add variables to the current state.
 
-    def update_context(self, context: Dict[str, Any]) -> None:
-        for k, v in context.items():
-            self.set_variable(k, v)
+        :param generation: state generation the context was computed for,
+            context is dropped if the state was replaced in the meantime
+        """
+        with self._state_lock:
+            if generation is not None and generation != self.state.generation:
+                return
 
-        self.context.update(**context)
+            self.ctx.update(context)
+            self.state = replace(self.state, context={**self.state.context, **context})
 
     def start(self) -> None:
         pass
 
-    def reset(self) -> None:
-        self.environ = copy(self.environ_before)
-        for n, v in self.context.items():
-            self.default(f"del {n}")
+    def refresh_commands_cache(self) -> None:
+        """
+        Rescan commands in PATH directories.
+        """
+        builtins.__xonsh__.commands_cache.all_commands  # type: ignore
+
+    def set_env_vars(self, env_vars: Dict[str, str]) -> None:
+        """
+        Replace variables of the previous env, only variables that changed are set.
 
-        self.context = {}
-        self.pre_cmd = None
-        self.on_stdout = None
-        self.on_stderr = None
-        self.post_cmd = None
+        Variables of the previous env missing in the new one are restored to their original values.
+        """
+        current = self.environ.detype()
+
+        for key in self._env_vars.keys() - env_vars.keys():
+            if key in self.environ_before:
+                self.environ[key] = self.environ_before[key]
+            elif key in current:
+                del self.environ[key]
+
+        for key, value in env_vars.items():
+            if current.get(key) != value:
+                self.environ[key] = value
+
+        self._env_vars = env_vars
 
     @property
     def prompt(self) -> str:
@@ -81,6 +358,7 @@ class Shell(BaseShell):  # type: ignore
         import signal
         from xonsh.built_ins import load_builtins
         from xonsh.built_ins import XonshSession
+        from xonsh.environ import default_env
         from xonsh.imphooks import install_import_hooks
         from xonsh.xontribs import xontribs_load
         import xonsh.history.main as xhm
@@ -92,6 +370,8 @@ class Shell(BaseShell):  # type: ignore
         builtins.__xonsh__ = XonshSession(ctx=ctx, execer=execer)  # type: ignore
 
         load_builtins(ctx=ctx, execer=execer)
+        # same as xonsh does it in XonshSession.load
+        builtins.__xonsh__.env = Environ(default_env())  # type: ignore
         env = builtins.__xonsh__.env  # type: ignore
         env.update({"XONSH_INTERACTIVE": True, "SHELL_TYPE": "prompt_toolkit"})
         builtins.__xonsh__.history = xhm.construct_history(  # type: ignore
@@ -117,60 +397,69 @@ class Shell(BaseShell):  # type: ignore
         return shell
 
     def default(self, line: str) -> Any:
-        self.cmd_lock.acquire()
-
-        class Stream:
-            device: TextIO
-
-            def __init__(self, command: str, on_write: Callable) -> None:
-                self.command = command
-                self.on_write = on_write
-                self.output: List[str] = []
-
-            def write(self, text: str) -> None:
-                if isinstance(text, bytes):
-                    text = text.decode("utf-8")
-
-                text = self.on_write(command=self.command, out=text)
-                self.output.append(text)
-                self.device.write(text)
-
-            def flush(self) -> None:
-                self.device.flush()
+        if not self.ready.is_set():
+            print("Waiting for env to load...")
+            self.ready.wait()
+
+        with self._command_lock:
+            state = self.state
+            self._apply_state(state)
+            try:
+                return self._default(line, state)
+            finally:
+                # state published while the command ran
+                self._apply_state(self.state)
+
+    def _default(self, line: str, state: ShellState) -> Any:
+        if state.pre_cmd:
+            line = state.pre_cmd(line)
+
+        if state.tee_output and state.tee_output(line):
+            assert state.on_stdout and state.on_stderr
+            # hooks are applied to everything written to stdout and stderr, streams just pass it on
+            with tee_output(line, state.on_stdout, state.on_stderr) as (
+                out_tee,
+                err_tee,
+            ):
+                ret = self._run(line, state.generation, on_stdout=None, on_stderr=None)
+            outputs = (out_tee.output, err_tee.output)
+        else:
+            needs_stdout, needs_stderr = (
+                state.needs_output(line) if state.needs_output else (True, True)
+            )
+            ret = self._run(
+                line,
+                state.generation,
+                on_stdout=state.on_stdout if needs_stdout else None,
+                on_stderr=state.on_stderr if needs_stderr else None,
+            )
+            outputs = (stdout.output, stderr.output)
+
+        if state.post_cmd:
+            state.post_cmd(command=line, stdout=outputs[0], stderr=outputs[1])
 
-        class StdOut(Stream):
-            device = sys.__stdout__
-
-        class StdErr(Stream):
-            device = sys.__stderr__
-
-        if self.pre_cmd:
-            line = self.pre_cmd(line)
-
-        out = None
-        if self.on_stdout:
-            out = StdOut(command=line, on_write=self.on_stdout)
-            sys.stdout = out  # type: ignore
+        return ret
 
-        err = None
-        if self.on_stderr:
-            err = StdErr(command=line, on_write=self.on_stderr)
-            sys.stderr = err  # type: ignore
+    def _run(
+        self,
+        line: str,
+        generation: int,
+        on_stdout: Optional[Callable],
+        on_stderr: Optional[Callable],
+    ) -> Any:
+        stdout.start(line, on_stdout)
+        stderr.start(line, on_stderr)
+        sys.stdout = stdout  # type: ignore
+        sys.stderr = stderr  # type: ignore
 
         try:
-            ret = super().default(line)
-            if self.on_stdout:
-                sys.stdout = sys.__stdout__
-
-            if self.on_stderr:
-                sys.stderr = sys.__stderr__
-
-            if self.post_cmd and out and err:
-                self.post_cmd(command=line, stdout=out.output, stderr=err.output)
+            with tracer.span("shell_command", generation=generation, line=line):
+                return super().default(line)
         finally:
-            self.cmd_lock.release()
-
-        return ret
+            sys.stdout = sys.__stdout__
+            sys.stderr = sys.__stderr__
+            stdout.finish()
+            stderr.finish()
 
 
 class FancyShell(Shell, PromptToolkitShell):  # type: ignore
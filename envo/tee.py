@@ -0,0 +1,153 @@
+import fcntl
+import os
+import pty
+import select
+import sys
+import termios
+from contextlib import contextmanager
+from threading import Thread
+from typing import Callable, Iterator, List, Optional, Tuple
+
+import xonsh.jobs
+from loguru import logger
+
+from envo.misc import LineBuffer
+
+__all__ = ["FdTee", "tee_output"]
+
+
+class FdTee:
+    """
+    Pass everything written to a file descriptor, by this process and its subprocesses, through a hook.
+
+    The descriptor is replaced with a pty (or a pipe if it's not a terminal) read by a thread
+    that calls the hook and writes its result to the original descriptor.
+    Output is passed to the hook line by line, incomplete lines (like prompts) are passed
+    after a short delay so interactive programs stay responsive.
+    Writes to the original descriptor block, so a slow terminal or hook slows the writer down
+    instead of buffering its output.
+    """
+
+    latency_s = 0.05
+    chunk_size = 64 * 1024
+
+    def __init__(self, fd: int, command: str, on_write: Callable) -> None:
+        """
+        :param on_write: hook called with command and text written to the descriptor
+        """
+        self.fd = fd
+        self.command = command
+        self.on_write = on_write
+        self.output: List[str] = []
+        self.saved_fd = -1
+        self._thread: Optional[Thread] = None
+
+    def start(self) -> None:
+        self.saved_fd = os.dup(self.fd)
+        if os.isatty(self.saved_fd):
+            reader, writer = pty.openpty()
+            attrs = termios.tcgetattr(self.saved_fd)
+            # newlines are translated once, by the real terminal
+            attrs[1] &= ~termios.OPOST
+            termios.tcsetattr(writer, termios.TCSANOW, attrs)
+            winsize = fcntl.ioctl(self.saved_fd, termios.TIOCGWINSZ, b"\0" * 8)
+            fcntl.ioctl(writer, termios.TIOCSWINSZ, winsize)
+        else:
+            reader, writer = os.pipe()
+
+        os.dup2(writer, self.fd)
+        os.close(writer)
+
+        self._thread = Thread(
+            target=self._pump,
+            args=(reader, self.saved_fd),
+            name=f"envo-tee-{self.fd}",
+            daemon=True,
+        )
+        self._thread.start()
+
+    def stop(self, timeout_s: float = 1.0) -> None:
+        """
+        Restore the descriptor and wait until output written so far goes through the hook.
+
+        :param timeout_s: background processes may keep the pty open, they're piped through
+            the hook until they close it
+        """
+        os.dup2(self.saved_fd, self.fd)
+        assert self._thread
+        self._thread.join(timeout_s)
+
+    def _pump(self, reader: int, writer: int) -> None:
+        lines = LineBuffer("surrogateescape")
+        try:
+            while True:
+                ready, _, _ = select.select(
+                    [reader], [], [], self.latency_s if lines.pending else None
+                )
+                if not ready:
+                    self._emit(writer, lines.take_pending())
+                    continue
+
+                try:
+                    data = os.read(reader, self.chunk_size)
+                except OSError:
+                    # pty raises EIO when all its writers are closed
+                    data = b""
+                if not data:
+                    break
+
+                self._emit(writer, "".join(lines.feed(data)))
+                if len(lines.pending) > self.chunk_size:
+                    self._emit(writer, lines.take_pending())
+
+            self._emit(writer, lines.take_pending())
+        finally:
+            os.close(reader)
+            os.close(writer)
+
+    def _emit(self, writer: int, text: str) -> None:
+        if not text:
+            return
+
+        try:
+            text = self.on_write(command=self.command, out=text)
+        except Exception:
+            logger.exception(f"Output hook failed for {self.command}")
+        self.output.append(text)
+
+        data = memoryview(text.encode("utf-8", "surrogateescape"))
+        while data:
+            written = os.write(writer, data)
+            data = data[written:]
+
+
+def _flush_std_streams() -> None:
+    for stream in (sys.__stdout__, sys.__stderr__):
+        if stream:
+            stream.flush()
+
+
+@contextmanager
+def tee_output(
+    command: str, on_stdout: Callable, on_stderr: Callable
+) -> Iterator[Tuple[FdTee, FdTee]]:
+    """
+    Pass stdout and stderr of this process and its subprocesses through hooks.
+    """
+    _flush_std_streams()
+
+    stdout = FdTee(1, command, on_stdout)
+    stderr = FdTee(2, command, on_stderr)
+    stdout.start()
+    stderr.start()
+
+    # xonsh gives the terminal to foreground jobs through stderr, which is a pty now
+    fd_stderr = xonsh.jobs.FD_STDERR
+    xonsh.jobs.FD_STDERR = stderr.saved_fd
+    try:
+        yield stdout, stderr
+    finally:
+        xonsh.jobs.FD_STDERR = fd_stderr
+        _flush_std_streams()
+        stderr.stop()
+        stdout.stop()
@@ -0,0 +1,86 @@
+import atexit
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional, Set
+
+from envo.misc import write_atomic
+
+__all__ = ["Tracer", "tracer"]
+
+
+class Tracer:
+    """
+    Record spans in Chrome trace event format, viewable in Perfetto or chrome://tracing.
+
+    Spans are recorded only if path is set, otherwise they're no-ops.
+    Each span carries id of the thread it was recorded in, nesting is derived from timestamps.
+    """
+
+    def __init__(self, path: Optional[str] = None) -> None:
+        self.path = Path(path).absolute() if path else None
+        self.events: List[Dict[str, Any]] = []
+        self._threads: Set[int] = set()
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def span(self, name: str, cat: str = "envo", **args: Any) -> Iterator[None]:
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.complete(name, start, time.monotonic(), cat, **args)
+
+    def complete(
+        self, name: str, start: float, end: float, cat: str = "envo", **args: Any
+    ) -> None:
+        """
+        Record span that has already finished.
+
+        :param start: time.monotonic() when span started
+        :param end: time.monotonic() when span ended
+        """
+        if not self.path:
+            return
+
+        pid = os.getpid()
+        tid = threading.get_native_id()
+        event = {
+            "name": name,
+            "cat": cat,
+            "ph": "X",
+            "ts": start * 1e6,
+            "dur": (end - start) * 1e6,
+            "pid": pid,
+            "tid": tid,
+            "args": {k: str(v) for k, v in args.items()},
+        }
+
+        with self._lock:
+            if tid not in self._threads:
+                self._threads.add(tid)
+                self.events.append(
+                    {
+                        "name": "thread_name",
+                        "ph": "M",
+                        "pid": pid,
+                        "tid": tid,
+                        "args": {"name": threading.current_thread().name},
+                    }
+                )
+            self.events.append(event)
+
+    def save(self) -> None:
+        if not self.path or not self.events:
+            return
+
+        with self._lock:
+            content = json.dumps({"traceEvents": self.events, "displayTimeUnit": "ms"})
+        write_atomic(self.path, content)
+
+
+tracer = Tracer(os.environ.get("ENVO_TRACE"))
+atexit.register(tracer.save)
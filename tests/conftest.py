@@ -1,6 +1,7 @@
 import os
 import shutil
 from pathlib import Path
+from threading import Thread
 from typing import Generator
 
 from loguru_caplog import loguru_caplog as caplog  # noqa: ignore F401
@@ -9,6 +10,8 @@ from pytest import fixture
 test_root = Path(os.path.realpath(__file__)).parent
 envo_root = test_root.parent
 
+thread_start = Thread.start
+
 
 @fixture
 def sandbox() -> Generator:
@@ -17,9 +20,11 @@ def sandbox() -> Generator:
         shutil.rmtree(str(sandbox_dir))
 
     sandbox_dir.mkdir()
+    cwd = os.getcwd()
     os.chdir(str(sandbox_dir))
 
     yield
+    os.chdir(cwd)
     if sandbox_dir.exists():
         shutil.rmtree(str(sandbox_dir))
 
@@ -40,6 +45,14 @@ def mock_threading(mocker) -> None:
     mocker.patch("threading.Thread.start")
 
 
+@fixture
+def real_threading(mocker) -> None:
+    """
+    Undo mock_threading for tests that need threads actually running.
+    """
+    mocker.patch("threading.Thread.start", thread_start)
+
+
 @fixture
 def flake_cmd() -> None:
     from tests.utils import flake_cmd
@@ -47,6 +47,16 @@ def mock_shell(mocker) -> None:
     mocker.patch("envo.shell.Shell.create")
 
 
+@fixture
+def sync_loading(mocker) -> None:
+    """
+    Load env synchronously since threads are mocked in unit tests.
+    """
+    from envo.scripts import Envo
+
+    mocker.patch("envo.scripts.Envo._start_loading", Envo.restart)
+
+
 @fixture
 def init_child_env() -> None:
     from tests.unit.utils import init_child_env
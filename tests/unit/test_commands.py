@@ -1,5 +1,12 @@
+import json
 import os
 import re
+import sys
+from pathlib import Path
+
+import pytest
+
+from envo.jobs import bg
 from tests.unit import utils
 
 environ_before = os.environ.copy()
@@ -87,3 +94,285 @@ class TestCommands(utils.TestBase):
         e = utils.env()
         assert repr(e.mypy) == "\b"
         assert capsys.readouterr().out == "Mypy all good\n"
+
+    def test_cmd_deps(self, capsys, real_threading):
+        utils.init()
+        utils.flake_cmd(prop=False, glob=False)
+        utils.mypy_cmd(prop=False, glob=False)
+        utils.add_command(
+            """
+            @command(prop=False, glob=False, deps=["flake", "mypy"])
+            def ci(self) -> str:
+                print("Ci all good")
+                return "Ci return value"
+            """
+        )
+
+        e = utils.env()
+        assert e.ci() == "Ci return value"
+        out = capsys.readouterr().out.splitlines()
+        assert sorted(out[:2]) == ["[flake] Flake all good", "[mypy] Mypy all good"]
+        assert out[2] == "Ci all good"
+
+    def test_cmd_deps_failure_cancels_dependents(self, capsys, real_threading):
+        utils.init()
+        utils.add_command(
+            """
+            @command(prop=False, glob=False)
+            def failing(self) -> None:
+                run("exit 3", pty=False)
+
+            @command(prop=False, glob=False, deps=["failing"])
+            def build(self) -> None:
+                print("Build")
+
+            @command(prop=False, glob=False, deps=["build"])
+            def ci(self) -> None:
+                print("Ci")
+            """
+        )
+
+        e = utils.env()
+        with pytest.raises(SystemExit) as exc:
+            e.ci()
+
+        assert exc.value.code == 3
+        assert "Build" not in capsys.readouterr().out
+
+    def test_cmd_incremental(self, capsys):
+        utils.init()
+        utils.add_command(
+            """
+            @command(prop=False, glob=False, inputs=["*.txt"])
+            def build(self) -> str:
+                print("Building")
+                with Path("runs").open("a") as f:
+                    f.write("run\\n")
+                return "Build return value"
+            """
+        )
+        Path("input.txt").write_text("1")
+
+        e = utils.env()
+        assert e.build() == "Build return value"
+        assert e.build() == "Build return value"
+        assert capsys.readouterr().out == "Building\nBuilding\n"
+        assert Path("runs").read_text() == "run\n"
+
+        Path("input.txt").write_text("2")
+        e.build()
+        assert Path("runs").read_text() == "run\nrun\n"
+
+        e.build(force=True)
+        assert Path("runs").read_text() == "run\nrun\nrun\n"
+
+    def test_cmd_incremental_store(self, capsys):
+        utils.init()
+        utils.add_command(
+            """
+            @command(prop=False, glob=False, inputs=["*.txt"])
+            def build(self) -> None:
+                print("Building")
+            """
+        )
+        Path("a.txt").write_text("1")
+        Path("b.txt").write_text("1")
+        store = Path(".envo/fingerprints.json")
+
+        e = utils.env()
+        e.build()
+        inode = store.stat().st_ino
+        # skipped runs don't write the store
+        e.build()
+        assert store.stat().st_ino == inode
+
+        Path("b.txt").unlink()
+        Path("a.txt").write_text("2")
+        e.build()
+        assert [Path(f).name for f in json.loads(store.read_text())["files"]] == [
+            "a.txt"
+        ]
+        assert capsys.readouterr().out == "Building\nBuilding\nBuilding\n"
+
+    def test_cmd_incremental_deps(self, capsys, real_threading):
+        utils.init()
+        utils.add_command(
+            """
+            @command(prop=False, glob=False, inputs=["a.txt"])
+            def build_a(self) -> None:
+                import time
+
+                for i in range(5):
+                    print(f"Building a {i}")
+                    time.sleep(0.01)
+
+            @command(prop=False, glob=False, inputs=["b.txt"])
+            def build_b(self) -> None:
+                import time
+
+                for i in range(5):
+                    print(f"Building b {i}")
+                    time.sleep(0.01)
+
+            @command(prop=False, glob=False, deps=["build_a", "build_b"])
+            def ci(self) -> None:
+                print("Ci")
+            """
+        )
+        Path("a.txt").write_text("1")
+        Path("b.txt").write_text("1")
+        stdout = sys.stdout
+
+        e = utils.env()
+        e.ci()
+        capsys.readouterr()
+        e.ci()
+
+        assert sys.stdout is stdout
+        out = capsys.readouterr().out.splitlines()
+        assert sorted(line for line in out if line.startswith("[build_a]")) == [
+            f"[build_a] Building a {i}" for i in range(5)
+        ]
+        assert sorted(line for line in out if line.startswith("[build_b]")) == [
+            f"[build_b] Building b {i}" for i in range(5)
+        ]
+        assert out[-1] == "Ci"
+
+    def test_run_cmd(self, capsys):
+        utils.add_command(
+            """
+            @command
+            def build(self, target: str, jobs: int = 1, verbose: bool = False) -> str:
+                print(f"Building {target} with {jobs} jobs" + (" verbosely" if verbose else ""))
+                return "done"
+            """
+        )
+
+        with pytest.raises(SystemExit) as e:
+            utils.command("test run build app --jobs 4 --verbose")
+
+        assert e.value.code == 0
+        assert capsys.readouterr().out == "Building app with 4 jobs verbosely\ndone\n"
+
+    def test_run_cmd_exit_code(self, capsys):
+        utils.add_command(
+            """
+            @command
+            def failing(self) -> None:
+                run("exit_with_error() { return 3; }; exit_with_error", print_output=False)
+            """
+        )
+
+        with pytest.raises(SystemExit) as e:
+            utils.command("test run failing")
+
+        assert e.value.code == 3
+
+    def test_run_unknown_cmd(self):
+        with pytest.raises(SystemExit) as e:
+            utils.command("test run missing")
+
+        assert e.value.code == 1
+        assert 'Unknown command "missing"' in str(self.mock_logger_error.call_args)
+        self.mock_logger_error = None
+
+    def test_run_cmd_profiled(self, capsys):
+        utils.add_command(
+            """
+            @command
+            def build(self) -> str:
+                from pathlib import Path
+
+                return str(sum(range(1000))) + Path(".").absolute().name
+            """
+        )
+        os.mkdir("subdir")
+        os.chdir("subdir")
+
+        with pytest.raises(SystemExit) as e:
+            utils.command("test run --profile build")
+
+        os.chdir("..")
+        assert e.value.code == 0
+        out = capsys.readouterr().out
+        assert "cumulative" in out
+        assert out.endswith("499500sandbox\n")
+        assert Path(".envo/profiles/test.build.pstats").exists()
+        assert "fn=build" in Path(".envo/profiles/callgrind.out.test.build").read_text()
+
+    def test_sampling_profile_decorator(self, capsys, real_threading):
+        utils.add_command(
+            """
+            @command(profile="sample")
+            def build(self) -> None:
+                import time
+
+                time.sleep(0.1)
+            """
+        )
+        e = utils.env()
+        e.build()
+
+        assert "samples every" in capsys.readouterr().out
+        assert (
+            "env_comm.py:build " in Path(".envo/profiles/test.build.folded").read_text()
+        )
+
+    def test_background_cmd(self, capsys, real_threading, monkeypatch):
+        utils.add_command(
+            """
+            @command(background=True)
+            def build(self, target: str) -> str:
+                import os
+
+                print(f"Building {target}")
+                print(os.environ["BUILD_TYPE"])
+                return target.upper()
+
+            @command
+            def failing(self) -> None:
+                raise ValueError("broken")
+            """
+        )
+        monkeypatch.setenv("BUILD_TYPE", "release")
+        e = utils.env()
+
+        job = e.build("app")
+        assert job.wait(timeout_s=10) == "APP"
+        assert job.status == "done"
+        assert list(job.follow()) == ["Building app", "release"]
+
+        failed = bg(e.failing)
+        failed.wait(timeout_s=10)
+        assert failed.status == "failed"
+        assert failed.error == "ValueError: broken"
+        assert failed.output[0].startswith("Traceback")
+        assert e.jobs().running == 0
+        assert "build done" in repr(e.jobs())
+
+    def test_run_cmd_in_stages(self, capsys, real_threading):
+        env_test = Path("env_test.py").read_text()
+        Path("env_ci.py").write_text(env_test.replace('stage = "test"', 'stage = "ci"'))
+        utils.add_command(
+            """
+            @command
+            def check(self) -> None:
+                import sys
+
+                print(f"Checking {self.meta.stage}")
+                sys.exit(3 if self.meta.stage == "ci" else 0)
+            """
+        )
+        env_comm = Path("env_comm.py")
+        env_comm.write_text(env_comm.read_text() + '\nprint("Loading comm")\n')
+
+        with pytest.raises(SystemExit) as e:
+            utils.command("--stages test,ci run check")
+
+        assert e.value.code == 3
+        out = capsys.readouterr().out
+        assert re.search(r"=== test \(done in .* s\) ===\nChecking test\n", out)
+        assert re.search(r"=== ci \(failed in .* s\) ===\nChecking ci\n", out)
+        assert re.search(r"test +done +0 .*\nci +failed +3 ", out)
+        # imported once, before workers are forked
+        assert out.count("Loading comm") == 1
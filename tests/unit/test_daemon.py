@@ -0,0 +1,88 @@
+import os
+import time
+from pathlib import Path
+from threading import Thread
+
+import pytest
+
+from envo.daemon import Daemon, find_socket, request
+from tests.unit import utils
+
+
+class TestDaemon(utils.TestBase):
+    @pytest.fixture
+    def daemon(self, real_threading):
+        daemon = Daemon(Path(".").absolute())
+        thread = Thread(target=daemon.serve)
+        thread.start()
+
+        while not daemon.socket_path.exists():
+            time.sleep(0.01)
+
+        yield daemon
+
+        daemon.stop()
+        thread.join()
+
+    def request(self, daemon: Daemon, cmd: str):
+        read_fd, write_fd = os.pipe()
+        code = request(daemon.socket_path, cmd.split(), fds=(0, write_fd, write_fd))
+        os.close(write_fd)
+
+        with os.fdopen(read_fd) as f:
+            return code, f.read()
+
+    def test_dry_run(self, daemon):
+        assert find_socket() == daemon.socket_path
+
+        code, out = self.request(daemon, "test --dry-run")
+        assert code == 0
+        assert 'export SANDBOX_STAGE="test"' in out
+
+    def test_run_and_reload(self, daemon):
+        utils.flake_cmd()
+        code, out = self.request(daemon, "test run flake")
+        assert code == 0
+        assert out == "Flake all good\nFlake return value\n"
+
+        utils.replace_in_code("Flake all good", "Flake reloaded")
+        code, out = self.request(daemon, "test run flake")
+        assert out == "Flake reloaded\nFlake return value\n"
+
+    def test_socket_owner_only(self, daemon, mocker):
+        assert daemon.socket_path.stat().st_mode & 0o777 == 0o600
+
+        mocker.patch("os.getuid", return_value=os.getuid() + 1)
+        with pytest.raises(ConnectionError):
+            self.request(daemon, "test --dry-run")
+
+        assert "Rejected request" in str(self.mock_logger_error.call_args)
+        self.mock_logger_error = None
+
+    def test_exit_code(self, daemon):
+        code, out = self.request(daemon, "test exec -- python3 -c exit(3)")
+        assert code == 3
+
+    def test_shell_in_pty(self, daemon):
+        utils.add_command(
+            """
+            @onload
+            def on_load(self) -> None:
+                import os
+
+                print(f"loaded, tty: {os.isatty(0)}")
+            """
+        )
+        stdin_read_fd, stdin_write_fd = os.pipe()
+        read_fd, write_fd = os.pipe()
+        code = request(
+            daemon.socket_path,
+            ["test"],
+            fds=(stdin_read_fd, write_fd, write_fd),
+            pty=True,
+        )
+        os.close(write_fd)
+
+        assert code == 0
+        with os.fdopen(read_fd) as f:
+            assert f.read() == "loaded, tty: True\n"
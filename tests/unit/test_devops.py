@@ -1,8 +1,9 @@
 import os
+import re
 
 import pytest
 
-from envo import run
+from envo import run, run_iter, run_parallel
 
 environ_before = os.environ.copy()
 
@@ -70,3 +71,214 @@ class TestRun:
         result = run("""non_existend_command""", ignore_errors=True)
         assert len(result) == 1
         assert "non_existend_command: command not found" in result[0]
+
+    def test_batch_multiple_results(self, capsys):
+        result = run(
+            """
+        export VAR1=123
+        echo "test"
+        echo -n "test$VAR1"
+        """,
+            batch=True,
+        )
+        assert len(result) == 2
+        assert result[0] == "test"
+        assert result[1] == "test123"
+
+        assert capsys.readouterr().out == "test\r\ntest123"
+
+    def test_batch_exceptions(self, capsys):
+        with pytest.raises(SystemExit) as e:
+            run(
+                """
+                echo "test1"
+                echo "throws error" && missing_command
+                echo "test2"
+                """,
+                batch=True,
+            )
+
+        out, err = capsys.readouterr()
+
+        assert "missing_command: command not found\r\n" in out
+        assert "test2" not in out
+        assert e.value.code == 127
+
+    def test_batch_ignore_errors(self):
+        result = run(
+            """
+            non_existend_command
+            echo "test"
+            """,
+            ignore_errors=True,
+            batch=True,
+        )
+        assert len(result) == 2
+        assert "non_existend_command: command not found" in result[0]
+        assert result[1] == "test"
+
+    def test_no_pty_multiple_results(self, capsys):
+        result = run(
+            """
+        export VAR1=123
+        echo "test"
+        echo -n "test$VAR1"
+        """,
+            pty=False,
+        )
+        assert len(result) == 2
+        assert result[0] == "test"
+        assert result[1] == "test123"
+
+        assert capsys.readouterr().out == "test\ntest123"
+
+    def test_no_pty_exceptions(self, capsys):
+        with pytest.raises(SystemExit) as e:
+            run(
+                """
+                echo "test1"
+                echo "throws error" && missing_command
+                echo "test2"
+                """,
+                pty=False,
+            )
+
+        out, err = capsys.readouterr()
+
+        assert "missing_command: command not found\n" in out
+        assert "test2" not in out
+        assert e.value.code == 127
+
+    def test_no_pty_ignore_errors(self):
+        result = run("""non_existend_command""", ignore_errors=True, pty=False)
+        assert len(result) == 1
+        assert "non_existend_command: command not found" in result[0]
+
+    def test_run_iter(self, capsys):
+        lines = list(
+            run_iter(
+                """
+                echo "test1"
+                echo "test2"
+                echo -n "test3"
+                """
+            )
+        )
+        assert lines == ["test1", "test2", "test3"]
+        assert capsys.readouterr().out == ""
+
+    def test_run_iter_stop_early(self, tmp_path):
+        marker_file = tmp_path / "finished"
+        for line in run_iter(
+            f"""
+            echo "found"
+            sleep 5
+            touch {marker_file}
+            """
+        ):
+            if line == "found":
+                break
+
+        assert not marker_file.exists()
+
+    def test_run_iter_events(self):
+        events = list(run_iter("echo test\nfalse", ignore_errors=True, events=True))
+        assert [(e.type, e.index) for e in events] == [
+            ("start", 0),
+            ("output", 0),
+            ("exit", 0),
+            ("start", 1),
+            ("exit", 1),
+        ]
+        assert events[1].line == "test\n"
+        assert events[4].ret_code == 1
+
+    def test_run_iter_exceptions(self):
+        with pytest.raises(SystemExit) as e:
+            list(
+                run_iter("echo test\nexit_with_error() { return 3; }; exit_with_error")
+            )
+
+        assert e.value.code == 3
+
+    def test_results(self):
+        results = run(
+            """
+            echo "test"
+            echo "error" >&2
+            false
+            """,
+            pty=False,
+            ignore_errors=True,
+            print_output=False,
+            results=True,
+        )
+        assert [r.command for r in results] == [
+            'echo "test"',
+            'echo "error" >&2',
+            "false",
+        ]
+        assert [r.exit_code for r in results] == [0, 0, 1]
+        assert results[0].output == ["test"]
+        assert results[0].stdout_bytes == 5
+        assert results[1].stderr_bytes == 6
+        assert results[1].stdout_bytes == 0
+        assert all(r.wall_time >= 0 for r in results)
+
+    def test_results_cpu_time(self):
+        results = run(
+            'python3 -c "sum(range(10_000_000))"',
+            print_output=False,
+            results=True,
+        )
+        assert results[0].user_time + results[0].sys_time > 0
+
+    def test_results_summary(self, capsys):
+        with pytest.raises(SystemExit) as e:
+            run(
+                """
+                echo "test"
+                exit_with_error() { return 3; }; exit_with_error
+                """,
+                pty=False,
+                progress_bar=True,
+                results=True,
+            )
+
+        assert e.value.code == 3
+        out = capsys.readouterr().out
+        assert re.search(r"command\s+exit\s+wall", out)
+        assert re.search(r'echo "test"\s+0', out)
+        assert re.search(r"peak rss of the run \(largest process\): \d+ KiB", out)
+
+    def test_run_parallel(self, capsys):
+        result = run_parallel(
+            {
+                "first": """
+                sleep 0.2
+                echo "first"
+                """,
+                "second": 'echo "second"',
+            }
+        )
+        assert result == {"first": ["first"], "second": ["second"]}
+        assert capsys.readouterr().out == "[second] second\n[first] first\n"
+
+    def test_run_parallel_exceptions(self, capsys):
+        with pytest.raises(SystemExit) as e:
+            run_parallel({"failing": "missing_command", "ok": 'echo "ok"'})
+
+        assert e.value.code == 127
+        assert "[ok] ok\n" in capsys.readouterr().out
+
+    def test_no_pty_exit(self):
+        with pytest.raises(SystemExit) as e:
+            run(
+                """
+                echo "test"
+                exit 3
+                """,
+                pty=False,
+            )
+
+        assert e.value.code == 3
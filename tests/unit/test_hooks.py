@@ -0,0 +1,168 @@
+import subprocess
+from functools import partial
+from pathlib import Path
+
+from envo.hooks import HookGuard
+from envo.scripts import Envo
+from envo.tee import FdTee
+from tests.unit import utils
+
+
+class TestHooks(utils.TestBase):
+    def test_slow_hook_disabled(self, caplog, capsys):
+        utils.add_command(
+            """
+            @precmd(budget_ms=1, demote="disable")
+            def slow_pre(self, command: str) -> str:
+                import time
+
+                time.sleep(0.005)
+                return command + "_modified"
+            """
+        )
+        envo = Envo(Envo.Sets(stage="test", addons=[], init=False))
+        env = utils.env()
+
+        for i in range(HookGuard.demote_after):
+            assert envo._on_precmd(env, "ls") == "ls_modified"
+
+        assert envo._on_precmd(env, "ls") == "ls"
+        assert envo.hook_guard.hooks["slow_pre"].status == "disabled"
+        assert envo.hook_guard.hooks["slow_pre"].calls == HookGuard.demote_after
+        assert caplog.messages[0].startswith('Hook "slow_pre" took')
+        assert caplog.messages[1].startswith('Hook "slow_pre" is too slow, disabled')
+
+        envo.hook_guard.enable("slow_pre")
+        assert envo._on_precmd(env, "ls") == "ls_modified"
+        assert "slow_pre" in repr(envo.hook_guard)
+
+        capsys.readouterr()
+
+    def test_slow_rewriting_hook_kept(self, caplog, capsys):
+        utils.add_command(
+            """
+            @onstdout(budget_ms=1)
+            def slow_mask(self, command: str, out: str) -> str:
+                import time
+
+                time.sleep(0.005)
+                return out.replace("secret", "***")
+            """
+        )
+        envo = Envo(Envo.Sets(stage="test", addons=[], init=False))
+        env = utils.env()
+
+        for i in range(HookGuard.demote_after * 2):
+            assert envo._on_stdout(env, "ls", "secret\n") == "***\n"
+
+        assert envo.hook_guard.hooks["slow_mask"].status == "active"
+        assert len(caplog.messages) == 1
+        assert caplog.messages[0].startswith('Hook "slow_mask" took')
+
+        capsys.readouterr()
+
+    def test_default_budget_postcmd_async(self, capsys, real_threading):
+        utils.replace_in_code(
+            'emoji = "🛠"',
+            'emoji = "🛠"\n        hook_budget_ms = 1',
+            file=Path("env_test.py"),
+        )
+        utils.add_command(
+            """
+            @postcmd
+            def slow_post(self, command: str, stdout: List[str], stderr: List[str]) -> None:
+                import time
+
+                time.sleep(0.005)
+            """
+        )
+        envo = Envo(Envo.Sets(stage="test", addons=[], init=False))
+        env = utils.env()
+
+        for i in range(HookGuard.demote_after):
+            envo._on_postcmd(env, "ls", [], [])
+
+        assert envo.hook_guard.hooks["slow_post"].status == "async"
+        assert envo.hook_guard.hooks["slow_post"].budget_ms == 1
+
+        capsys.readouterr()
+
+    def test_sub_hooks_merged(self):
+        utils.add_command(
+            """
+            mask = onstdout.sub(r"token-\\w+", "***")
+            swap = onstdout.sub(r"(\\w+)@(\\w+)", r"\\2 at \\1")
+            upper = onstdout.sub(r"loud", lambda m: m.group(0).upper())
+            only_git = onstdout.sub(r"main", "master", cmd_regex=r"git.*")
+            """
+        )
+        envo = Envo(Envo.Sets(stage="test", addons=[], init=False))
+        env = utils.env()
+
+        out = envo._on_stdout(env, "ls", "token-abc user@host loud main\n")
+        assert out == "*** host at user LOUD main\n"
+        assert envo._on_stdout(env, "git status", "on main") == "on master"
+        assert env.mask.name == "mask"
+        assert "sub('token-\\\\w+', '***')" in repr(env)
+
+    def test_sub_hooks_not_mergeable(self):
+        utils.add_command(
+            """
+            first = onstderr.sub(r"(?P<word>a)", "b")
+            second = onstderr.sub(r"(?P<word>b)", "c")
+            """
+        )
+        envo = Envo(Envo.Sets(stage="test", addons=[], init=False))
+        env = utils.env()
+
+        assert envo._on_stderr(env, "ls", "ab") == "cc"
+
+    def test_sub_hooks_with_backreferences(self):
+        utils.add_command(
+            """
+            wrap = onstdout.sub(r"(x)", r"[\\1]")
+            double = onstdout.sub(r"(a)\\1", "DOUBLE")
+            """
+        )
+        envo = Envo(Envo.Sets(stage="test", addons=[], init=False))
+        env = utils.env()
+
+        assert envo._on_stdout(env, "ls", "aa x ax") == "DOUBLE [x] a[x]"
+
+    def test_tee_subprocess_output(self, real_threading):
+        utils.add_command(
+            """
+            mask = onstdout.sub(r"token-\\w+", "***", cmd_regex=r"kubectl.*", tee=True)
+
+            @onstderr(cmd_regex=r"kubectl.*")
+            def on_err(self, command: str, out: str) -> str:
+                return out.upper()
+            """
+        )
+        envo = Envo(Envo.Sets(stage="test", addons=[], init=False))
+        env = utils.env()
+
+        assert envo._tee_output(env, "kubectl get secrets")
+        assert not envo._tee_output(env, "ls")
+
+        with open("out.txt", "wb") as out_file, open("err.txt", "wb") as err_file:
+            out = FdTee(
+                out_file.fileno(), "kubectl get secrets", partial(envo._on_stdout, env)
+            )
+            err = FdTee(
+                err_file.fileno(), "kubectl get secrets", partial(envo._on_stderr, env)
+            )
+            out.start()
+            err.start()
+            subprocess.run(
+                ["sh", "-c", "echo token-abc; echo error >&2; printf 'prompt: '"],
+                stdout=out.fd,
+                stderr=err.fd,
+            )
+            err.stop()
+            out.stop()
+
+        assert Path("out.txt").read_text() == "***\nprompt: "
+        assert Path("err.txt").read_text() == "ERROR\n"
+        assert "".join(out.output) == "***\nprompt: "
+        assert err.output == ["ERROR\n"]
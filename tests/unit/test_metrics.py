@@ -0,0 +1,69 @@
+import json
+from pathlib import Path
+
+import pytest
+
+from envo.metrics import Histogram, metrics
+from tests.unit import utils
+
+
+class TestMetrics(utils.TestBase):
+    def test_histogram(self):
+        h = Histogram()
+        for d in [0.3, 0.4, 3, 7, 200]:
+            h.observe(d)
+
+        assert h.count == 5
+        assert h.max_ms == 200
+        assert h.percentile(0.5) == 5
+        assert h.percentile(0.95) == 200
+
+    def test_run_cmd_metrics_saved(self, capsys, monkeypatch):
+        monkeypatch.setenv("ENVO_METRICS_FILE", str(Path("metrics.prom").absolute()))
+        metrics.clear()
+        utils.add_command(
+            """
+            @command
+            def build(self) -> None:
+                print("building")
+            """
+        )
+
+        for i in range(2):
+            with pytest.raises(SystemExit):
+                utils.command("test run build")
+
+        capsys.readouterr()
+        utils.command("test stats --json")
+        stats = json.loads(capsys.readouterr().out)
+        build = next(s for s in stats if s["name"] == "build")
+        assert build["type"] == "command"
+        assert build["count"] == 2
+
+        assert (
+            'envo_magic_function_duration_ms_count{type="command",name="build"} 2'
+            in (Path("metrics.prom").read_text())
+        )
+
+        utils.command("test stats")
+        assert "build" in capsys.readouterr().out
+
+        utils.command("test stats --reset")
+        utils.command("test stats --json")
+        assert json.loads(capsys.readouterr().out) == []
+
+    def test_env_stats(self):
+        metrics.clear()
+        utils.add_command(
+            """
+            @command
+            def build(self) -> None:
+                pass
+            """
+        )
+        env = utils.env()
+        env.build()
+
+        assert env.stats().histograms[("command", "build")].count == 1
+        assert "build" in repr(env.stats())
+        metrics.clear()
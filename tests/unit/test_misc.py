@@ -1,12 +1,19 @@
 import os
 import re
+import subprocess
+import sys
 from pathlib import Path
+from threading import Event
+from unittest.mock import MagicMock
 
 import pytest
 
 import envo.scripts
+from envo.scripts import Envo
 from tests.unit import utils
 
+start_loading = Envo._start_loading
+
 environ_before = os.environ.copy()
 
 
@@ -76,6 +83,74 @@ class TestMisc(utils.TestBase):
         assert captured.out == ""
         assert captured.err == ""
 
+    def test_compile(self, caplog):
+        utils.command("test --compile")
+
+        assert caplog.messages[0].startswith("Compiled activation scripts")
+        for f in ["test.bash", "test.zsh", "test.fish", "test.env"]:
+            assert "SANDBOX_STAGE" in Path(f".envo/{f}").read_text()
+
+        bash_script = Path(".envo/test.bash")
+        inode = bash_script.stat().st_ino
+        utils.command("test --compile")
+        assert bash_script.stat().st_ino == inode
+
+        out = subprocess.check_output(
+            ["bash", "-c", ". .envo/activate_test.sh; echo $SANDBOX_STAGE"]
+        )
+        assert out == b"test\n"
+
+    def test_sh_loader_quoting(self):
+        from envo.activation import _render_sh_loader
+
+        root = Path('it\'s "$HOME"')
+        (root / ".envo").mkdir(parents=True)
+        source = root / "env_test.py"
+        source.touch()
+        script = root / ".envo/test.bash"
+        script.write_text("echo loaded\n")
+        loader = root / ".envo/activate_test.sh"
+        loader.write_text(
+            _render_sh_loader("test", script.absolute(), [source.absolute()])
+        )
+        os.utime(source, (0, 0))
+
+        out = subprocess.check_output(["bash", "-c", '. "$0"', str(loader)])
+        assert out == b"loaded\n"
+
+    def test_exec(self, mocker, capsys):
+        utils.add_command(
+            """
+            @onload
+            def on_load(self) -> None:
+                print("loaded")
+            """
+        )
+        mock_execvpe = mocker.patch("os.execvpe")
+        utils.command("test exec -- ls -l")
+
+        mock_execvpe.assert_called_once()
+        program, argv, environ = mock_execvpe.call_args.args
+        assert program == "ls"
+        assert argv == ["ls", "-l"]
+        assert environ["SANDBOX_STAGE"] == "test"
+        assert capsys.readouterr().out == "loaded\n"
+
+    def test_background_loading(self, real_threading):
+        envo = Envo(Envo.Sets(stage="test", addons=[], init=False))
+        envo.shell = MagicMock()
+        envo.shell.ready = Event()
+        sys.path.insert(0, str(Path(".").absolute()))
+
+        start_loading(envo)
+        envo._loading_thread.join()
+        envo._set_context_thread.join()
+        sys.path.pop(0)
+
+        assert envo.shell.set_prompt_prefix.call_args_list[0].args == ("⏳(test)",)
+        assert envo.shell.ready.is_set()
+        assert envo.env.meta.stage == "test"
+
     def test_activating(self, env):
         env.activate()
         assert os.environ["SANDBOX_STAGE"] == "test"
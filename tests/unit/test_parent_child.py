@@ -81,3 +81,35 @@ class TestParentChild(utils.TestBase):
 
         assert "child_bin_dir" in os.environ["PATH"]
         assert "parent_bin_dir" in os.environ["PATH"]
+
+    def test_paths_deduplicated(self, init_child_env):
+        child_dir = Path(".").absolute() / "child"
+
+        utils.add_declaration("path: Raw[str]")
+        utils.add_definition(
+            """
+            import os
+            self.path = "/shared_bin_dir:/parent_bin_dir:" + os.environ["PATH"]
+            """
+        )
+        utils.add_declaration("path: Raw[str]", file=child_dir / "env_comm.py")
+        utils.add_definition(
+            """
+            import os
+            self.path = "/child_bin_dir:/shared_bin_dir:" + os.environ["PATH"]
+            """,
+            file=child_dir / "env_comm.py",
+        )
+
+        # already activated in this shell
+        os.environ["PATH"] = "/child_bin_dir:/usr/bin:/usr/bin/"
+        child_env = utils.env(child_dir)
+        child_env.activate()
+
+        assert (
+            os.environ["PATH"]
+            == "/child_bin_dir:/shared_bin_dir:/parent_bin_dir:/usr/bin"
+        )
+        assert len(os.environ["PYTHONPATH"].split(":")) == len(
+            set(os.environ["PYTHONPATH"].split(":"))
+        )
@@ -0,0 +1,125 @@
+import gc
+import os
+import sys
+from functools import lru_cache
+from pathlib import Path
+from threading import Thread
+
+from envo.env import Env, MagicFunction
+from envo.misc import dedupe_paths
+from envo.scripts import Envo
+from envo.shell import Shell
+from tests.unit import utils
+
+create_shell = lru_cache(maxsize=None)(Shell.create)
+
+
+def rss_kb() -> int:
+    pages = int(Path("/proc/self/statm").read_text().split()[1])
+    return pages * os.sysconf("SC_PAGE_SIZE") // 1024
+
+
+def live_objects() -> int:
+    gc.collect()
+    return len(gc.get_objects())
+
+
+def count(type: type) -> int:
+    gc.collect()
+    return sum(isinstance(o, type) for o in gc.get_objects())
+
+
+class TestReload(utils.TestBase):
+    def reload(self, envo: Envo, n: int) -> None:
+        for i in range(n):
+            envo.restart()
+            assert envo._set_context_thread
+            envo._set_context_thread.join()
+
+    def test_reloads_dont_leak(
+        self, real_threading, init_child_env, capsys, monkeypatch
+    ):
+        site_packages = Path(".venv/lib/python3.8/site-packages").absolute()
+        site_packages.mkdir(parents=True)
+        utils.add_declaration("venv: envo.VenvEnv")
+        utils.add_definition("self.venv = envo.VenvEnv(self)")
+        utils.add_command(
+            """
+            @command
+            def build(self) -> None:
+                pass
+
+            @context
+            def ctx(self) -> Dict[str, Any]:
+                return {"value": 1}
+
+            @precmd
+            def pre(self, command: str) -> str:
+                return command
+            """,
+            file=Path("child/env_comm.py"),
+        )
+
+        sys_path = sys.path.copy()
+        os.chdir("child")
+        envo = Envo(Envo.Sets(stage="test", addons=[], init=False))
+        sys.path.insert(0, str(envo.env_dirs[0]))
+        # xonsh parses sys.argv when creating the shell, it's created once since every shell
+        # replaces xonsh builtins
+        monkeypatch.setattr(sys, "argv", ["envo"])
+        envo.shell = create_shell()
+        sys_path_before = sys.path.copy()
+
+        try:
+            # warm up caches
+            self.reload(envo, 5)
+            # counting loads xonsh lazy objects so it's done before measuring memory
+            envs_before = count(Env)
+            magic_functions_before = count(MagicFunction)
+            rss_before = rss_kb()
+            objects_before = live_objects()
+            modules_before = set(sys.modules.keys())
+
+            self.reload(envo, 50)
+
+            assert live_objects() - objects_before < 500
+            assert rss_kb() - rss_before < 10 * 1024
+            assert envo.env.get_parent()
+            # earlier tests may leave duplicates in sys.path
+            assert sys.path == dedupe_paths([str(site_packages)] + sys_path_before)
+            assert set(sys.modules.keys()) == modules_before
+            # envs of earlier tests may be still alive
+            assert count(Env) == envs_before
+            assert count(MagicFunction) == magic_functions_before
+        finally:
+            sys.path[:] = sys_path
+            os.chdir("..")
+
+        capsys.readouterr()
+
+    def test_reload_during_command(self, real_threading, monkeypatch):
+        utils.add_declaration("value: str")
+        utils.add_definition('self.value = "old"')
+
+        sys_path = sys.path.copy()
+        envo = Envo(Envo.Sets(stage="test", addons=[], init=False))
+        sys.path.insert(0, str(envo.env_dirs[0]))
+        monkeypatch.setattr(sys, "argv", ["envo"])
+        envo.shell = create_shell()
+
+        try:
+            self.reload(envo, 1)
+            assert envo.shell.environ["SANDBOX_VALUE"] == "old"
+
+            utils.replace_in_code('"old"', '"new"')
+            # reload while a command runs
+            with envo.shell._command_lock:
+                reload = Thread(target=self.reload, args=(envo, 1))
+                reload.start()
+                reload.join()
+                assert envo.shell.environ["SANDBOX_VALUE"] == "old"
+
+            envo.shell.default("x = 1")
+            assert envo.shell.environ["SANDBOX_VALUE"] == "new"
+        finally:
+            sys.path[:] = sys_path
@@ -0,0 +1,60 @@
+import io
+import sys
+
+from envo.shell import Environ, OutputStream
+from tests.unit import utils
+
+
+class TestShell(utils.TestBase):
+    def test_environ_detype_cached(self):
+        environ = Environ({"PATH": "/bin:/usr/bin", "SOME_VAR": "1"})
+
+        detyped = environ.detype()
+        assert detyped["PATH"] == "/bin:/usr/bin"
+        assert detyped["SOME_VAR"] == "1"
+
+        # reading mutable variables doesn't drop the cache
+        assert environ["PATH"]
+        assert environ.detype() is detyped
+
+        environ["OTHER_VAR"] = "2"
+        del environ["SOME_VAR"]
+        new_detyped = environ.detype()
+        assert new_detyped["OTHER_VAR"] == "2"
+        assert "SOME_VAR" not in new_detyped
+        # returned dicts are not modified
+        assert detyped["SOME_VAR"] == "1"
+        assert "OTHER_VAR" not in detyped
+
+        environ["PATH"].append("/sbin")
+        assert environ.detype()["PATH"] == "/bin:/usr/bin:/sbin"
+
+    def test_output_stream(self, monkeypatch):
+        raw = io.BytesIO()
+        device = io.TextIOWrapper(io.BufferedWriter(raw), encoding="utf-8")
+        monkeypatch.setattr(sys, "__stdout__", device)
+        stream = OutputStream("stdout")
+
+        device.write("prompt ")
+        stream.start("ls", on_write=None)
+        # xonsh writes bytes to the buffer if there's one
+        assert stream.buffer is device.buffer
+        stream.buffer.write(b"file\n")
+        stream.write("text\n")
+        assert raw.getvalue() == b"prompt file\ntext\n"
+        # flushed again by a timer within the flush interval
+        stream.write("more\n")
+        assert stream._timer
+        stream.finish()
+
+        assert raw.getvalue() == b"prompt file\ntext\nmore\n"
+        assert stream.output == []
+
+        stream.start("ls", on_write=lambda command, out: out.upper())
+        assert not hasattr(stream, "buffer")
+        stream.write("file\n")
+        stream.write("żółw\n".encode("utf-8"))
+        stream.finish()
+
+        assert raw.getvalue() == "prompt file\ntext\nmore\nFILE\nŻÓŁW\n".encode("utf-8")
+        assert stream.output == ["FILE\n", "ŻÓŁW\n"]
@@ -0,0 +1,69 @@
+import json
+from pathlib import Path
+from threading import Thread
+
+import pytest
+
+from envo.trace import Tracer, tracer
+from tests.unit import utils
+
+
+class TestTrace(utils.TestBase):
+    def test_spans_in_threads(self, real_threading):
+        t = Tracer("trace.json")
+
+        def work() -> None:
+            with t.span("inner", cat="test", n=1):
+                pass
+
+        with t.span("outer"):
+            thread = Thread(target=work, name="worker")
+            thread.start()
+            thread.join()
+        t.save()
+
+        events = json.loads(Path("trace.json").read_text())["traceEvents"]
+        spans = {e["name"]: e for e in events if e["ph"] == "X"}
+        thread_names = {e["args"]["name"] for e in events if e["ph"] == "M"}
+
+        assert spans["inner"]["tid"] != spans["outer"]["tid"]
+        assert spans["inner"]["args"] == {"n": "1"}
+        assert spans["outer"]["ts"] <= spans["inner"]["ts"]
+        assert spans["outer"]["dur"] >= spans["inner"]["dur"]
+        assert "worker" in thread_names
+
+    def test_run_cmd_traced(self, capsys, monkeypatch):
+        monkeypatch.setattr(tracer, "path", Path("trace.json").absolute())
+        monkeypatch.setattr(tracer, "events", [])
+        utils.add_command(
+            """
+            @command
+            def build(self) -> None:
+                run("echo building", pty=False)
+            """
+        )
+
+        with pytest.raises(SystemExit):
+            utils.command("test run build")
+        tracer.save()
+
+        events = json.loads(Path("trace.json").read_text())["traceEvents"]
+        names = [(e.get("cat"), e["name"]) for e in events if e["ph"] == "X"]
+        assert ("envo", "startup") in names
+        assert ("command", "build") in names
+        assert ("run", "run") in names
+        assert ("run", "echo building") in names
+
+        capsys.readouterr()
+
+    def test_exec_traced(self, mocker, monkeypatch):
+        monkeypatch.setattr(tracer, "path", Path("trace.json").absolute())
+        monkeypatch.setattr(tracer, "events", [])
+        mocker.patch("os.execvpe")
+
+        utils.command("test exec -- ls")
+
+        events = json.loads(Path("trace.json").read_text())["traceEvents"]
+        assert ("envo", "startup") in [
+            (e.get("cat"), e["name"]) for e in events if e["ph"] == "X"
+        ]
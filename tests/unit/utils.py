@@ -39,6 +39,7 @@ class TestBase:
         mock_logger_error,
         mock_threading,
         mock_shell,
+        sync_loading,
         sandbox,
         init,
         version,